@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""PSU_Async.py: asyncio counterpart of PsuControlCom, so one event loop can drive many serial buses at once."""
+
+__author__      = "Owen Dennis McGinnis"
+__email__       = "mcginnis@atom.uni-frankfurt.de"
+
+
+import asyncio
+import sys
+import serial
+from time import monotonic
+
+from PSU_Control import (PsuBatch, PsuBus, PsuControlCom, PsuLinkNegotiator, PsuTopology, missingFrameError,
+                         printableError, PsuTrace, TRACE)
+
+
+class AsyncPsuBus(PsuBus):
+    """A PsuBus whose transactions are coroutines.
+
+    The port is switched to non-blocking reads and writes. Where it has a file
+    descriptor and the loop can watch it, the loop wakes up as soon as bytes
+    arrive, otherwise the port is polled every pollInterval. The bookkeeping
+    (latency, metrics, tracing, stray answers) is the one of PsuBus.
+    """
+    pollInterval = 0.002
+
+    def __init__(self):
+        super().__init__()
+        self.lock = asyncio.Lock()
+        self.fd = None
+
+    def open(self, port, baudrate=9600):
+        super().open(port, baudrate)
+        con = self.serialConnection
+        con.timeout = 0
+        con.write_timeout = 0
+        try:
+            self.fd = con.fileno()
+        except (AttributeError, OSError, serial.SerialException):
+            self.fd = None
+        return self
+
+    async def write(self, *commands):
+        async with self.lock:
+            return await self._write(commands)
+
+    async def _write(self, commands):
+        self.checkConnection(1)
+        await self.dropStray()
+        commands, urgent = self.takeUrgent(commands)
+        data = self.encode(commands)
+        started = monotonic()
+        self.metrics.begin(started)
+        try:
+            await self.send(data)
+        except serial.serialutil.SerialException as err:
+            self.metrics.end(monotonic())
+            self.fault(commands[0], err)
+        self.written(commands, data, started)
+        for done in urgent:
+            done(self.writeTime)
+        return self
+
+    def urgent(self, channel, commands, done=None):
+        # Sent by a task as soon as the lock is free, or in front of the next
+        # write. Without a running loop (another thread) only the latter.
+        self.urgentLines.append((channel, tuple(commands), done))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self
+        loop.create_task(self.sendUrgent())
+        return self
+
+    async def sendUrgent(self):
+        async with self.lock:
+            if self.urgentLines and self.is_connected():
+                try:
+                    await self._write(())
+                except printableError as err:
+                    print("Urgent write failed:", err, file=sys.stderr)
+
+    async def send(self, data):
+        con = self.serialConnection
+        while True:
+            written = con.write(data)
+            if written is None or written >= len(data):
+                return
+            # The output buffer is full, it drains at the baud rate
+            data = data[written:]
+            await asyncio.sleep(len(data) * 10 / con.baudrate)
+
+    async def dropStray(self):
+        try:
+            if self.outstanding:
+                deadline = self.strayDeadline()
+                while self.outstanding:
+                    frame = await self.readFrame(deadline)
+                    if frame is None:
+                        break
+                    self.dropFrame(frame)
+                self.outstanding = 0
+            await self.receive()
+        except serial.serialutil.SerialException:
+            return
+        self.dropRest()
+
+    async def receive(self, timeout=0):
+        con = self.serialConnection
+        waiting = con.in_waiting
+        if not waiting and timeout > 0:
+            await self.readable(timeout)
+            waiting = con.in_waiting
+        if waiting:
+            self.parser.feed(con.read(waiting))
+            self.metrics.bytesReceived += waiting
+        return waiting
+
+    async def readable(self, timeout):
+        # Returns once bytes are waiting or the timeout passed
+        if self.fd is not None:
+            loop = asyncio.get_running_loop()
+            ready = loop.create_future()
+            try:
+                loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(None))
+            except NotImplementedError:
+                # Loops without readers, like the proactor loop on Windows
+                self.fd = None
+            else:
+                try:
+                    await asyncio.wait_for(ready, timeout)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    loop.remove_reader(self.fd)
+                return
+        await asyncio.sleep(min(timeout, self.pollInterval))
+
+    async def read(self, command=""):
+        async with self.lock:
+            return await self._read(command)
+
+    async def _read(self, command):
+        self.checkConnection(0)
+        key = self.latency.key(command)
+        start = max(self.writeTime, self.frameTime)
+        try:
+            frame = await self.readFrame(start + self.latency.timeout(key))
+            if frame is None and self.parser.pending():
+                frame = await self.readFrame(start + self.latency.hardTimeout(key))
+        except serial.serialutil.SerialException as err:
+            self.fault(command, err)
+        return self.answer(command, key, start, frame)
+
+    async def readFrame(self, deadline):
+        while True:
+            frame = self.parser.nextFrame()
+            if frame is not None:
+                return frame
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            await self.receive(remaining)
+
+    async def scan(self, addresses=range(1, 30), chunk=None):
+        # Same probe as PsuBus.scan
+        addresses = list(addresses)
+        chunk = PsuBatch.pipelineDepth if chunk is None else chunk
+        key = self.latency.key("CH?")
+        found = set()
+        async with self.lock:
+            for i in range(0, len(addresses), chunk):
+                commands = []
+                for address in addresses[i:i + chunk]:
+                    commands += ["CH {}".format(address), "CH?"]
+                await self._write(commands)
+                sent = self.writeTime + len(self.encode(commands)) * 10 / self.serialConnection.baudrate
+                while True:
+                    frame = await self.readFrame(max(sent, self.frameTime) + self.latency.hardTimeout(key))
+                    if frame is None:
+                        break
+                    self.frameTime = monotonic()
+                    try:
+                        found.add(int(frame.decode("utf-8").strip()))
+                    except ValueError:
+                        self.strayCount += 1
+                self.outstanding = 0
+            self.metrics.end(monotonic())
+            self.activeChannel = None
+        return sorted(found.intersection(addresses))
+
+    async def connect(self, port, baudrate=None, adapter=None):
+        # PsuBus.connect with the probes of PsuLinkNegotiator awaited
+        if baudrate is not None:
+            return self.open(port, baudrate)
+        negotiator = PsuLinkNegotiator()
+        addresses = PsuTopology().cached(port) or range(1, 30)
+        for baudrate, tries, new in negotiator.attempts(port, adapter):
+            if await self.probe(port, baudrate, addresses, tries):
+                if new:
+                    negotiator.accept(port, baudrate, adapter)
+                return self
+        raise negotiator.failed(port)
+
+    async def probe(self, port, baudrate, addresses, tries):
+        # PsuLinkNegotiator.probe
+        self.open(port, baudrate)
+        try:
+            found = await self.scan(addresses)
+            stable = bool(found)
+            for _ in range(tries - 1):
+                stable = stable and await self.scan(found) == found
+        except (printableError, serial.SerialException):
+            stable = False
+        if not stable:
+            self.close()
+        return stable
+
+
+class AsyncPsuBatch(PsuBatch):
+    """A PsuBatch of an AsyncPsuControlCom, executed with await."""
+    async def execute(self):
+        async with self.com.bus.lock:
+            return await self._execute()
+
+    async def _execute(self):
+        for chunk in self.chunks():
+            for commands, apply, values in await self.exchange(chunk):
+                apply(*values)
+        self.com.commitSample()
+        return self.com
+
+    async def exchange(self, chunk):
+        # Same retry as PsuBatch.exchange
+        for attempt in range(2):
+            await self.com._write([command for step in chunk for command in step[0]])
+            try:
+                return [(commands, apply, [convert(await self.com._read(command)) for command in commands])
+                        for commands, apply, convert in chunk if apply is not None]
+            except (missingFrameError, ValueError):
+                if attempt:
+                    raise
+                self.com.bus.metrics.retries += 1
+                if TRACE.level:
+                    TRACE.event(PsuTrace.RETRY, self.com.channel, chunk[0][0][0], 0, 0)
+
+class AsyncPsuControlCom:
+    """Awaitable version of PsuControlCom on an AsyncPsuBus.
+
+    The state lives in a PsuControlCom (com), whose update methods queue their
+    queries in an AsyncPsuBatch. Its attributes (status, voltageSet, samples,
+    ...) can be read on this object directly.
+    """
+    def __init__(self, channel=1, bus=None):
+        self.com = PsuControlCom(channel, AsyncPsuBus() if bus is None else bus)
+
+    def __getattr__(self, name):
+        return getattr(self.com, name)
+
+    def open(self, port, baudrate=9600):
+        self.bus.open(port, baudrate)
+        return self
+
+    async def write(self, *commands):
+        async with self.bus.lock:
+            await self._write(commands)
+        return self
+
+    async def _write(self, commands):
+        if self.bus.activeChannel != self.channel and not commands[0].startswith("CH "):
+            commands = ["CH {}".format(self.channel)] + list(commands)
+        await self.bus._write(commands)
+
+    async def read(self, command=""):
+        async with self.bus.lock:
+            return await self._read(command)
+
+    async def _read(self, command):
+        return await self.bus._read(command)
+
+    def batch(self):
+        return AsyncPsuBatch(self)
+
+    async def execute(self, *updates):
+        # Queues the updates of com in one batch and runs it
+        batch = self.batch()
+        for update in updates:
+            update(batch)
+        await batch.execute()
+        return self
+
+    async def initialCom(self):
+        self.cache.clear()
+        for _ in range(5):
+            try:
+                await self.execute(lambda batch: self.com.setChannel(self.channel, batch).updateStatus(batch))
+            except printableError as err:
+                if str(err) != "Could not read from serial interface":
+                    raise printableError(err)
+                await asyncio.sleep(1)
+                continue
+            else:
+                break
+        com = self.com
+        return await self.execute(com.updateRemoteStatus, com.updateMaxValues, com.updateSetCurrent,
+                                  com.updateSetVoltage, com.updateFrontpanelStatus,
+                                  com.updateMeasuredCurrent, com.updateMeasuredVoltage)
+
+    async def saveUpdate(self):
+        return await self.execute(self.com.saveUpdate)
+
+    async def fullUpdate(self):
+        return await self.execute(self.com.fullUpdate)
+
+    async def setChannel(self, channel):
+        return await self.execute(lambda batch: self.com.setChannel(channel, batch))
+
+    async def readChannel(self):
+        return await self.execute(self.com.readChannel)
+
+    async def updateStatus(self):
+        return await self.execute(self.com.updateStatus)
+
+    async def updateRemoteStatus(self):
+        return await self.execute(self.com.updateRemoteStatus)
+
+    async def updateMaxValues(self):
+        return await self.execute(self.com.updateMaxValues)
+
+    async def updateSetCurrent(self):
+        return await self.execute(self.com.updateSetCurrent)
+
+    async def updateSetVoltage(self):
+        return await self.execute(self.com.updateSetVoltage)
+
+    async def updateMeasuredCurrent(self):
+        if self.status != 0:
+            self.com.updateMeasuredCurrent()
+            return self
+        return await self.execute(self.com.updateMeasuredCurrent)
+
+    async def updateMeasuredVoltage(self):
+        if self.status != 0:
+            self.com.updateMeasuredVoltage()
+            return self
+        return await self.execute(self.com.updateMeasuredVoltage)
+
+    async def updateFrontpanelStatus(self):
+        return await self.execute(self.com.updateFrontpanelStatus)
+
+    def voltageRequestedSet(self, val):
+        self.com.voltageRequestedSet(val)
+        return self
+
+    def currentRequestedSet(self, val):
+        self.com.currentRequestedSet(val)
+        return self
+
+    async def setVoltage(self):
+        return await self.execute(self.com.setVoltage)
+
+    async def setCurrent(self):
+        return await self.execute(self.com.setCurrent)
+
+    async def psuOn(self):
+        return await self.execute(self.com.psuOn)
+
+    async def psuOff(self):
+        return await self.execute(self.com.psuOff)
+
+    async def psuRemote(self):
+        return await self.execute(self.com.psuRemote)
+
+    async def psuLocal(self):
+        return await self.execute(self.com.psuLocal)
+
+    async def fpLock(self):
+        return self
+
+    async def fpUnlock(self):
+        return self
+
+async def discover(bus, rescan=False, addresses=range(1, 30)):
+    # PsuTopology.discover for an AsyncPsuBus
+    topology = PsuTopology()
+    cached = None if rescan else topology.cached(bus.port)
+    if cached and await bus.scan(cached) == sorted(cached):
+        return cached
+    channels = {}
+    for channel in await bus.scan(addresses):
+        com = AsyncPsuControlCom(channel, bus)
+        await com.setChannel(channel)
+        await com.updateMaxValues()
+        try:
+            await com.execute(com.com.updateIdentification)
+        except missingFrameError:
+            pass
+        channels[channel] = PsuTopology.identity(com)
+    return topology.remember(bus.port, channels)
+
+async def updateAll(coms, update="fullUpdate"):
+    # Runs update on all channels at once. Channels on one bus take turns on
+    # its lock in the given order, the buses work concurrently. A failing bus
+    # does not stop the others: its channels get the exception in the result.
+    return await asyncio.gather(*(getattr(com, update)() for com in coms), return_exceptions=True)
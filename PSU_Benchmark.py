@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""PSU_Benchmark.py: Measures command throughput and latency of PsuControlCom against simulated supplies."""
+
+__author__      = "Owen Dennis McGinnis"
+__email__       = "mcginnis@atom.uni-frankfurt.de"
+
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+from time import perf_counter
+
+from PSU_Control import PROJECT_PATH, STARTUP_BUDGET, PsuBus, PsuControlCom, printableError, __version__
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+def summarize(name, timings, operations=1):
+    ordered = sorted(timings)
+    total = sum(ordered)
+    return {
+        "name": name,
+        "samples": len(ordered),
+        "operations": operations * len(ordered),
+        "total": total,
+        "mean": total / len(ordered) if ordered else None,
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+        "max": ordered[-1] if ordered else None,
+        "rate": operations * len(ordered) / total if total else None,
+    }
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    # PsuControlCom reports on stdout, which would swamp the results
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+class Benchmark:
+    def __init__(self, channels=(1,), latency=0.005, measureLatency=0.05, baudrate=9600, repeat=20, throttle=True):
+        self.channels = tuple(channels)
+        self.latency = latency
+        self.measureLatency = measureLatency
+        self.baudrate = baudrate
+        self.repeat = repeat
+        self.throttle = throttle
+        self.bus = None
+        self.coms = []
+
+    def url(self):
+        return "psusim://?channels={}&latency={}&measure={}&throttle={}".format(
+            ",".join(str(channel) for channel in self.channels), self.latency,
+            self.measureLatency, 1 if self.throttle else 0)
+
+    def setup(self):
+        self.bus = PsuBus().open(self.url(), self.baudrate)
+        self.coms = [PsuControlCom(channel, self.bus) for channel in self.channels]
+        for com in self.coms:
+            com.initialCom()
+            com.voltageRequestedSet(1.0).setVoltage()
+            com.currentRequestedSet(1.0).setCurrent()
+            com.psuRemote().psuOn()
+        return self
+
+    def teardown(self):
+        if self.bus is not None:
+            self.bus.close()
+
+    def timed(self, func, repeat=None):
+        timings = []
+        for _ in range(self.repeat if repeat is None else repeat):
+            start = perf_counter()
+            func()
+            timings.append(perf_counter() - start)
+        return timings
+
+    def singleQuery(self):
+        com = self.coms[0]
+        def query():
+            com.cache.invalidate("voltageSet")
+            com.updateSetVoltage()
+        return summarize("singleQuery", self.timed(query, self.repeat * 5))
+
+    def initialCom(self):
+        return summarize("initialCom", self.timed(self.coms[0].initialCom))
+
+    def saveUpdate(self):
+        return summarize("saveUpdate", self.timed(self.coms[0].saveUpdate))
+
+    def saveUpdateCold(self):
+        com = self.coms[0]
+        def update():
+            com.cache.clear()
+            com.saveUpdate()
+        return summarize("saveUpdateCold", self.timed(update))
+
+    def fullUpdate(self):
+        return summarize("fullUpdate", self.timed(self.coms[0].fullUpdate))
+
+    def sweep(self):
+        def sweep():
+            for com in self.coms:
+                com.fullUpdate()
+        return summarize("sweep", self.timed(sweep), len(self.coms))
+
+    def setpointWrite(self):
+        com = self.coms[0]
+        values = [0.5 + (i % 10) * 0.1 for i in range(self.repeat * 5)]
+        def write():
+            for value in values:
+                com.voltageRequestedSet(value).setVoltage()
+            # Writes have no answer, a query makes sure the device got them all
+            com.readChannel()
+        return summarize("setpointWrite", self.timed(write, 1), len(values))
+
+    def coldStart(self):
+        # Fresh interpreter each time: python PSU_Control.py --version
+        command = [sys.executable, str(PROJECT_PATH / "PSU_Control.py"), "--version"]
+        def start():
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        result = summarize("coldStart", self.timed(start, max(self.repeat // 2, 3)))
+        result["budget"] = STARTUP_BUDGET
+        return result
+
+    workloads = ("singleQuery", "initialCom", "saveUpdate", "saveUpdateCold", "fullUpdate", "sweep", "setpointWrite",
+                 "coldStart")
+
+    def run(self, workloads=None, verbose=False):
+        results = []
+        with quiet(not verbose):
+            self.setup()
+            try:
+                for name in workloads or self.workloads:
+                    results.append(getattr(self, name)())
+            finally:
+                self.teardown()
+        return {
+            "version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "channels": list(self.channels),
+                "latency": self.latency,
+                "measureLatency": self.measureLatency,
+                "baudrate": self.baudrate,
+                "repeat": self.repeat,
+                "throttle": self.throttle,
+            },
+            "results": results,
+        }
+
+def compare(report, baseline, tolerance=0.1):
+    # Returns a line per workload and whether any got slower than allowed
+    regressions = False
+    lines = []
+    old = {result["name"]: result for result in baseline.get("results", [])}
+    for result in report["results"]:
+        reference = old.get(result["name"])
+        if reference is None:
+            lines.append("{:<16} new".format(result["name"]))
+            continue
+        worse, changes = [], []
+        for key in ("p50", "p95"):
+            # A reference of 0 or None (no samples) can not be compared against
+            if not reference.get(key) or result.get(key) is None:
+                changes.append("{} {:>7}".format(key, "n/a"))
+                continue
+            changes.append("{} {:+7.1%}".format(key, result[key] / reference[key] - 1))
+            if result[key] > reference[key] * (1 + tolerance):
+                worse.append(key)
+        regressions = regressions or bool(worse)
+        lines.append("{:<16} {}  {}".format(
+            result["name"], "  ".join(changes), "REGRESSION ({})".format(", ".join(worse)) if worse else "ok"))
+    return regressions, lines
+
+def printReport(report):
+    print("{:<16} {:>8} {:>10} {:>10} {:>10} {:>10}".format("workload", "samples", "p50 ms", "p95 ms", "p99 ms", "ops/s"))
+    for result in report["results"]:
+        print("{:<16} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+            result["name"], result["samples"], result["p50"] * 1e3, result["p95"] * 1e3,
+            result["p99"] * 1e3, result["rate"]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark PsuControlCom against simulated SM supplies.")
+    parser.add_argument("--channels", default="1,2,3,4", help="comma separated simulated channels")
+    parser.add_argument("--latency", type=float, default=0.005, help="device latency per command in s")
+    parser.add_argument("--measure-latency", type=float, default=0.05, help="device latency per MEasure query in s")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--no-throttle", action="store_true", help="do not limit the link to the baud rate")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--workload", action="append", choices=Benchmark.workloads,
+                        help="run only this workload, may be given several times")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--baseline", help="compare against this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    parser.add_argument("--verbose", action="store_true", help="keep the output of PsuControlCom")
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark([int(channel) for channel in args.channels.split(",")], args.latency,
+                          args.measure_latency, args.baudrate, args.repeat, not args.no_throttle)
+    try:
+        report = benchmark.run(args.workload, args.verbose)
+    except printableError as err:
+        print("Benchmark failed:", err, file=sys.stderr)
+        return 2
+    printReport(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions, lines = compare(report, baseline, args.tolerance)
+        print("\nAgainst baseline {}:".format(args.baseline))
+        for line in lines:
+            print(line)
+        if regressions:
+            return 1
+    for result in report["results"]:
+        if result.get("budget") is not None and result["p50"] > result["budget"]:
+            print("{} p50 {:.0f} ms is over its budget of {:.0f} ms".format(
+                result["name"], result["p50"] * 1e3, result["budget"] * 1e3), file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
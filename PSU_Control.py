@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-"""PSU_Control.py: Controls a RS232 SERIAL INTERFACE from Delta Elektonika, providing a gui."""
+"""PSU_Control.py: Controls a RS232 SERIAL INTERFACE from Delta Elektonika, providing a gui and a command line."""
 
 __author__      = "Owen Dennis McGinnis"
 __version__     = "0.2.3 A"
@@ -8,18 +8,21 @@ __email__       = "mcginnis@atom.uni-frankfurt.de"
 
 
 import pathlib
-import tkinter as tk
-import tkinter.ttk as ttk
-import pygubu
-import serial.tools.list_ports
 import serial
 import os
 import re
+import queue
+import threading
+import sys
+import struct
+import mmap
+from array import array
+from collections import deque
 # Open a file in default viewer
 # os.startfile(PROJECT_PATH / "bachelor_McGinnis.pdf")
 # Remember to add file to exe compilation
 #from pygubu.builder import tkstdwidgets, ttkstdwidgets
-from time import sleep
+from time import sleep, monotonic, time
 
 PROJECT_PATH = pathlib.Path(__file__).parent
 PROJECT_UI = PROJECT_PATH / "PSU_Control.ui"
@@ -27,91 +30,1094 @@ ICON_PATH  = PROJECT_PATH / "Icon.png"
 DOCUMENTAION_PATH  = PROJECT_PATH / "PSU_Control_manual.pdf"
 DEVICE_COM_NAME = "USB Serial Port"  # Name for testing arduino
 DEVICE_COM_REGEX = "{} [(].*[)]".format(DEVICE_COM_NAME)
+METRICS_PORT = None  # e.g. 9464 to serve Prometheus metrics on localhost
+TRACE_OFF    = 0  # No tracing at all
+TRACE_RECORD = 1  # Bus events go to an in-memory ring buffer, dumped on faults
+TRACE_PRINT  = 2  # Additionally print every event
+TRACE_LEVEL  = TRACE_RECORD
+STARTUP_BUDGET = 0.3  # s until the command line is ready, see PSU_Benchmark.py coldStart
+STATE_DIRECTORY = pathlib.Path(os.environ.get("PSU_CONTROL_STATE", pathlib.Path.home() / ".psu_control"))
+FRAME_TERMINATOR = b"\n\r\x04"
+BAUDRATES = (115200, 57600, 38400, 19200, 9600)  # Tried fastest first when no rate is given
+LOG_MAGIC = b"PSULOG\0\0"
+LOG_HEADER = struct.Struct("<8sHHHHd16s16s8x")
+LOG_RECORD = struct.Struct("<dddd")
+
+# psusim:// URLs open simulated supplies, see PSU_Simulator
+serial.protocol_handler_packages.append("PSU_Simulator")
 
 
 class printableError(Exception):
     pass
 
-class PsuControlCom:
-    def __init__(self, channel=1):
-        self.status     = -1
-        self.isRemote   = -1
-        self.frontpanel = -1
-        self.voltageSet = None
-        self.currentSet = None
-        self.voltageMeasured = None
-        self.currentMeasured = None
-        self.voltageMax = 0
-        self.currentMax = 0
-        self.voltageRequested = None
-        self.currentRequested = None
-        self.serialConnection = None
+class missingFrameError(printableError):
+    pass
+
+class PsuLatencyTracker:
+    """Learns the response time per command type and derives read timeouts.
+    
+    Until enough samples are collected the hard limit is used. Afterwards the
+    timeout is the observed percentile times margin, clamped to the limits. The
+    MEasure queries take considerably longer on the SM series, hence their own
+    hard limit.
+    """
+    def __init__(self, percentile=0.95, margin=2.0, samples=64, minTimeout=0.02, maxTimeout=0.2, measureTimeout=0.7):
+        self.percentile = percentile
+        self.margin = margin
+        self.samples = samples
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.measureTimeout = measureTimeout
+        self.latencies = {}
+        self._timeouts = {}
+    
+    @staticmethod
+    def key(command):
+        return command.split(" ")[0]
+    
+    @classmethod
+    def forLink(cls, baudrate, frameSize=32, turnaround=0.15, measureTurnaround=0.65, **kwargs):
+        # The hard limits are the time the supply needs plus twice the time a
+        # frameSize byte answer takes on the line (10 bits per byte), and no
+        # timeout is shorter than that line time. 9600 baud gives about the
+        # fixed limits of before.
+        transfer = 2 * frameSize * 10 / baudrate
+        return cls(minTimeout=max(0.02, transfer), maxTimeout=turnaround + transfer,
+                   measureTimeout=measureTurnaround + transfer, **kwargs)
+    
+    def hardTimeout(self, key):
+        return self.measureTimeout if key.startswith("MEasure") else self.maxTimeout
+    
+    def record(self, key, latency):
+        latencies = self.latencies.get(key)
+        if latencies is None:
+            latencies = self.latencies[key] = deque(maxlen=self.samples)
+        latencies.append(latency)
+        self._timeouts.pop(key, None)
+    
+    def timeout(self, key):
+        timeout = self._timeouts.get(key)
+        if timeout is not None:
+            return timeout
+        hard = self.hardTimeout(key)
+        latencies = self.latencies.get(key)
+        if latencies is None or len(latencies) < 8:
+            timeout = hard
+        else:
+            ordered = sorted(latencies)
+            timeout = ordered[int(self.percentile * (len(ordered) - 1))] * self.margin
+            timeout = min(max(timeout, self.minTimeout), hard)
+        self._timeouts[key] = timeout
+        return timeout
+
+class PsuTrace:
+    """Level gated tracing of bus traffic.
+    
+    With the level at TRACE_OFF the hot path only pays for one attribute test
+    (callers check trace.level before calling event). Otherwise every event is
+    packed into a 19 byte record (time, channel, command id, duration, bytes,
+    kind) in a preallocated ring buffer. Command strings are interned into ids.
+    The buffer is dumped when the connection fails, or on demand.
+    """
+    WRITE, READ, TIMEOUT, STRAY, RETRY, ERROR = range(6)
+    kinds = ("write", "read", "timeout", "stray", "retry", "error")
+    record = struct.Struct("<dHHfHB")
+    
+    def __init__(self, level=TRACE_RECORD, capacity=4096, dumpFile=None):
+        self.level = level
+        self.capacity = capacity
+        self.buffer = bytearray(self.record.size * capacity)
+        self.index = 0
+        self.count = 0
+        self.commandIds = {}
+        self.commands = []
+        self.dumpFile = dumpFile
+        self.lock = threading.Lock()
+    
+    def commandId(self, command):
+        key = command.split(" ")[0]
+        commandId = self.commandIds.get(key)
+        if commandId is None:
+            commandId = self.commandIds[key] = len(self.commands)
+            self.commands.append(key)
+        return commandId
+    
+    def event(self, kind, channel, command, duration, size):
+        with self.lock:
+            self.record.pack_into(self.buffer, self.index * self.record.size, monotonic(), channel or 0,
+                                  self.commandId(command), duration, min(size, 0xffff), kind)
+            self.index = (self.index + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+        if self.level >= TRACE_PRINT:
+            print(self.format((monotonic(), channel or 0, self.commandId(command), duration, size, kind)), file=sys.stderr)
+    
+    def log(self, level, message, *args):
+        if self.level >= level:
+            print(message.format(*args), file=sys.stderr)
+    
+    def fault(self, kind, channel, command, error):
+        if not self.level:
+            return
+        self.event(kind, channel, command, 0, 0)
+        file = sys.stderr if self.dumpFile is None else open(self.dumpFile, "a")
+        try:
+            print("Bus fault: {}\nLast {} bus events:".format(error, self.count), file=file)
+            self.dump(file)
+        finally:
+            if file is not sys.stderr:
+                file.close()
+    
+    def events(self):
+        # Oldest first
+        with self.lock:
+            data = bytes(self.buffer)
+            start = (self.index - self.count) % self.capacity
+            count = self.count
+        for i in range(count):
+            yield self.record.unpack_from(data, ((start + i) % self.capacity) * self.record.size)
+    
+    def format(self, event):
+        time, channel, commandId, duration, size, kind = event
+        return "{:12.6f} ch{:<2} {:<7} {:<24} {:8.2f} ms {:5d} B".format(
+            time, channel, self.kinds[kind], self.commands[commandId], duration * 1e3, size)
+    
+    def dump(self, file=None):
+        file = sys.stderr if file is None else file
+        for event in self.events():
+            print(self.format(event), file=file)
+    
+    def clear(self):
+        with self.lock:
+            self.index = 0
+            self.count = 0
+
+TRACE = PsuTrace(TRACE_LEVEL)
+
+class PsuMetrics:
+    """Counters and per command latency histograms of one bus.
+    
+    Recording is a dictionary lookup and a few additions, so it is always on.
+    Busy time runs from the first write until the last outstanding answer
+    arrived. render() returns the Prometheus text format.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.timeouts = {}
+        self.retries = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.channelSwitches = 0
+        self.urgentWrites = 0
+        self.busyTime = 0
+        self.busySince = None
+        self.started = monotonic()
+    
+    def observe(self, key, latency):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[-2] += 1
+        histogram[-1] += latency
+    
+    def timeout(self, key, now):
+        with self.lock:
+            self.timeouts[key] = self.timeouts.get(key, 0) + 1
+        self.end(now)
+    
+    def begin(self, now):
+        if self.busySince is None:
+            self.busySince = now
+    
+    def end(self, now):
+        if self.busySince is not None:
+            self.busyTime += max(now - self.busySince, 0)
+            self.busySince = None
+    
+    def utilization(self):
+        elapsed = monotonic() - self.started
+        busy = self.busyTime
+        if self.busySince is not None:
+            busy += monotonic() - self.busySince
+        return busy / elapsed if elapsed > 0 else 0
+    
+    def render(self, labels=""):
+        # labels is put into every sample, e.g. 'port="COM3"'
+        def fmt(extra=""):
+            both = ",".join(part for part in (labels, extra) if part)
+            return "{" + both + "}" if both else ""
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            timeouts = dict(self.timeouts)
+        lines = []
+        for key, values in sorted(histograms.items()):
+            command = 'command="{}"'.format(key.replace('"', ''))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                lines.append("psu_command_latency_seconds_bucket{} {}".format(fmt('{},le="{}"'.format(command, bound)), cumulative))
+            lines.append("psu_command_latency_seconds_sum{} {}".format(fmt(command), values[-1]))
+            lines.append("psu_command_latency_seconds_count{} {}".format(fmt(command), cumulative))
+        for key, count in sorted(timeouts.items()):
+            lines.append("psu_command_timeouts_total{} {}".format(fmt('command="{}"'.format(key.replace('"', ''))), count))
+        lines.append("psu_retries_total{} {}".format(fmt(), self.retries))
+        lines.append("psu_bytes_sent_total{} {}".format(fmt(), self.bytesSent))
+        lines.append("psu_bytes_received_total{} {}".format(fmt(), self.bytesReceived))
+        lines.append("psu_channel_switches_total{} {}".format(fmt(), self.channelSwitches))
+        lines.append("psu_urgent_writes_total{} {}".format(fmt(), self.urgentWrites))
+        lines.append("psu_bus_busy_seconds_total{} {}".format(fmt(), self.busyTime))
+        lines.append("psu_bus_utilization{} {}".format(fmt(), self.utilization()))
+        return lines
+
+METRICS_HELP = (
+    ("psu_command_latency_seconds", "histogram", "Time from sending a query until its answer arrived."),
+    ("psu_command_timeouts_total", "counter", "Queries whose answer never arrived."),
+    ("psu_retries_total", "counter", "Pipelined chunks sent again after a missing answer."),
+    ("psu_bytes_sent_total", "counter", "Bytes written to the serial port."),
+    ("psu_bytes_received_total", "counter", "Bytes read from the serial port."),
+    ("psu_channel_switches_total", "counter", "CH commands that changed the addressed channel."),
+    ("psu_urgent_writes_total", "counter", "Writes that carried lines of the urgent lane, e.g. interlock shutdowns."),
+    ("psu_bus_busy_seconds_total", "counter", "Time the bus spent on transactions."),
+    ("psu_bus_utilization", "gauge", "Busy time as fraction of the time since the bus was created."),
+    ("psu_stray_total", "counter", "Stale answers and stray bytes that were dropped."),
+)
+
+def renderMetrics(buses):
+    samples = []
+    for bus in buses:
+        labels = 'port="{}"'.format(str(bus.port).replace('"', ''))
+        samples += bus.metrics.render(labels)
+        samples.append("psu_stray_total{{{}}} {}".format(labels, bus.strayCount))
+    lines = []
+    for name, kind, text in METRICS_HELP:
+        lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines += [sample for sample in samples if sample.split("{")[0].split(" ")[0].startswith(name)]
+    return "\n".join(lines) + "\n"
+
+class PsuMetricsServer(threading.Thread):
+    """Serves renderMetrics for the given buses on http://host:port/metrics."""
+    def __init__(self, buses, port=9464, host="127.0.0.1"):
+        super().__init__(name="PsuMetricsServer", daemon=True)
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        getBuses = buses if callable(buses) else (lambda: buses)
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = renderMetrics(getBuses()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer((host, port), Handler)
+    
+    def run(self):
+        self.server.serve_forever()
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class PsuParamCache:
+    """Read-through cache for device parameters that rarely change.
+    
+    Each key has its own time to live, None keeps the value until it is
+    invalidated. Writes invalidate the keys they affect, a reconnect of the
+    bus (a new generation) drops everything.
+    """
+    defaultTtl = {
+        "max": None,
+        "identification": None,
+        "remote": 30.0,
+        "voltageSet": 10.0,
+        "currentSet": 10.0,
+    }
+    
+    def __init__(self, ttl=None):
+        self.ttl = dict(self.defaultTtl if ttl is None else ttl)
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self._generation = None
+    
+    def get(self, key):
+        entry = self.values.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or monotonic() < expires:
+                self.hits += 1
+                return True, value
+            del self.values[key]
+        self.misses += 1
+        return False, None
+    
+    def put(self, key, value):
+        ttl = self.ttl.get(key, 0)
+        self.values[key] = (None if ttl is None else monotonic() + ttl, value)
+        return self
+    
+    def invalidate(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+        return self
+    
+    def clear(self):
+        self.values.clear()
+        return self
+    
+    def generation(self, generation):
+        if generation != self._generation:
+            self._generation = generation
+            self.values.clear()
+        return self
+    
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.values)}
+
+class PsuSampleBuffer:
+    """Fixed size ring buffer of (time, voltage, current, status) samples.
+    
+    Each field lives in its own array('d'), so appending is O(1) and only
+    allocates once: the arrays are made for the first sample, channels that
+    are never polled cost nothing. column() returns memoryviews on the arrays,
+    split in the older and the newer part when the buffer has wrapped. An
+    optional writer gets every sample as well.
+    """
+    fields = ("time", "voltage", "current", "status")
+    
+    def __init__(self, capacity=36000, writer=None):
+        self.capacity = capacity
+        self.columns = None
+        self.head = 0
+        self.count = 0
+        self.total = 0
+        self.writer = writer
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return self.count
+    
+    def append(self, time, voltage, current, status):
+        voltage = float("nan") if voltage is None else voltage
+        current = float("nan") if current is None else current
+        with self.lock:
+            i = self.head
+            columns = self.columns
+            if columns is None:
+                columns = self.columns = {field: array("d", bytes(8 * self.capacity)) for field in self.fields}
+            columns["time"][i] = time
+            columns["voltage"][i] = voltage
+            columns["current"][i] = current
+            columns["status"][i] = status
+            self.head = (i + 1) % self.capacity
+            self.total += 1
+            if self.count < self.capacity:
+                self.count += 1
+        if self.writer is not None:
+            self.writer.write(time, voltage, current, status)
+        return self
+    
+    def column(self, field, last=None):
+        # Oldest first. Both views share memory with the buffer, so copy them
+        # before the buffer may wrap over them.
+        count = self.count if last is None else min(last, self.count)
+        if not count:
+            return (memoryview(array("d")),)
+        view = memoryview(self.columns[field])
+        start = (self.head - count) % self.capacity
+        if start + count <= self.capacity:
+            return (view[start:start + count],)
+        return (view[start:], view[:self.head])
+    
+    def since(self, mark, *fields):
+        # Copies of the samples appended after mark, which is total at an
+        # earlier call; returns the new mark first. Samples that were already
+        # overwritten are lost.
+        with self.lock:
+            count = min(self.total - mark, self.count)
+            columns = [array("d", b"".join(view.tobytes() for view in self.column(field, count))) for field in fields]
+            return (self.total,) + tuple(columns)
+    
+    def latest(self):
+        if not self.count:
+            return None
+        i = (self.head - 1) % self.capacity
+        return tuple(self.columns[field][i] for field in self.fields)
+    
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.count = 0
+        return self
+
+class PsuDecimator:
+    """Min/max envelope of one field of a PsuSampleBuffer over the whole run.
+    
+    Samples are folded into buckets of span seconds. Once there are twice
+    width buckets, neighbours are merged and the span doubles, so there are
+    never more than 2 * width buckets however long the run. update only reads
+    the samples appended since the last call. Negative values (measured -1
+    while the output is off) count as 0.
+    """
+    def __init__(self, buffer, field, width=300, span=1.0):
+        self.buffer = buffer
+        self.field = field
+        self.width = width
+        self.span = span
+        self.start = None
+        self.mins = array("d")
+        self.maxs = array("d")
+        self.mark = 0
+    
+    def update(self):
+        # Returns whether there was anything new
+        self.mark, times, values = self.buffer.since(self.mark, "time", self.field)
+        for sampleTime, value in zip(times, values):
+            self.add(sampleTime, value)
+        return bool(times)
+    
+    def add(self, sampleTime, value):
+        if value != value:
+            return
+        value = max(value, 0.0)
+        if self.start is None:
+            self.start = sampleTime
+        index = int((sampleTime - self.start) / self.span)
+        while index >= 2 * self.width:
+            self.merge()
+            index = int((sampleTime - self.start) / self.span)
+        if index >= len(self.mins):
+            missing = index + 1 - len(self.mins)
+            self.mins.extend([float("inf")] * missing)
+            self.maxs.extend([float("-inf")] * missing)
+        if value < self.mins[index]:
+            self.mins[index] = value
+        if value > self.maxs[index]:
+            self.maxs[index] = value
+    
+    def merge(self):
+        mins, maxs = self.mins, self.maxs
+        self.mins = array("d", (min(mins[i:i + 2]) for i in range(0, len(mins), 2)))
+        self.maxs = array("d", (max(maxs[i:i + 2]) for i in range(0, len(maxs), 2)))
+        self.span *= 2
+    
+    def polyline(self, width, height, top):
+        # Canvas coordinates of a zigzag through the minimum and maximum of
+        # every bucket, top is the value drawn at the upper edge
+        scale = height / top if top else 0
+        step = width / (2 * self.width)
+        coords = []
+        for i, (low, high) in enumerate(zip(self.mins, self.maxs)):
+            if low <= high:
+                x = i * step
+                coords += (x, height - low * scale, x, height - high * scale)
+        return coords
+
+class PsuSampleWriter:
+    """Writes samples to a CSV or raw binary file in chunks.
+    
+    The binary format is four little endian doubles per sample, in the order of
+    PsuSampleBuffer.fields. Samples are collected in an array('d') and only
+    written out once chunk samples are together, or on flush/close.
+    """
+    def __init__(self, path, binary=False, chunk=1024):
+        self.path = pathlib.Path(path)
+        self.binary = binary
+        self.chunk = chunk
+        self.pending = array("d")
+        self.file = open(self.path, "ab") if binary else open(self.path, "a", newline="")
+        if not binary and self.file.tell() == 0:
+            self.file.write(",".join(PsuSampleBuffer.fields) + "\n")
+    
+    def write(self, time, voltage, current, status):
+        self.pending.extend((time, voltage, current, status))
+        if len(self.pending) >= 4 * self.chunk:
+            self.flush()
+        return self
+    
+    def flush(self):
+        pending, self.pending = self.pending, array("d")
+        if self.binary:
+            if sys.byteorder == "big":
+                pending.byteswap()
+            pending.tofile(self.file)
+        else:
+            rows = (pending[i:i + 4] for i in range(0, len(pending), 4))
+            self.file.write("".join("{!r},{!r},{!r},{:d}\n".format(t, v, c, int(st)) for t, v, c, st in rows))
+        self.file.flush()
+        return self
+    
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class PsuBinaryLog(PsuSampleWriter):
+    """Appendable log of one channel with fixed size records.
+    
+    A 64 byte header (LOG_HEADER) holds the magic, version, header and record
+    size, channel, creation time, record layout and units. It is followed by
+    records of four little endian doubles: wall clock time, voltage, current
+    and status. The time is derived from the monotonic clock, so it never runs
+    backwards within a session and the file stays sorted by time. Numpy users
+    can map it as numpy.memmap(path, dtype="<f8", offset=64).reshape(-1, 4).
+    """
+    def __init__(self, path, channel, chunk=256):
+        path = pathlib.Path(path)
+        header = None
+        if path.exists() and path.stat().st_size >= LOG_HEADER.size:
+            with open(path, "rb") as file:
+                header = readLogHeader(file.read(LOG_HEADER.size))
+            if header["channel"] != channel:
+                raise printableError("Log file {} belongs to channel {}".format(path, header["channel"]))
+        super().__init__(path, binary=True, chunk=chunk)
+        if header is not None:
+            # Cut off a record that was only partly written before a crash
+            size = path.stat().st_size
+            self.file.truncate(size - (size - header["headerSize"]) % header["recordSize"])
+        else:
+            self.file.truncate(0)
+            self.file.write(LOG_HEADER.pack(LOG_MAGIC, 1, LOG_HEADER.size, LOG_RECORD.size, channel,
+                                            time(), b"<dddd", b"s V A status"))
+            self.file.flush()
         self.channel = channel
+        self.epoch = time() - monotonic()
+        self.lastTime = PsuBinaryLogReader(path).lastTime() if header is not None else None
+    
+    def write(self, sampleTime, voltage, current, status):
+        sampleTime += self.epoch
+        if self.lastTime is not None and sampleTime < self.lastTime:
+            # Keeps the file sorted if the clock was set back between sessions
+            sampleTime = self.lastTime
+        self.lastTime = sampleTime
+        return super().write(sampleTime, voltage, current, status)
+    
+    @staticmethod
+    def pathFor(directory, channel):
+        return pathlib.Path(directory) / "channel{:02d}.psulog".format(channel)
+
+class PsuBinaryLogReader:
+    """Memory mapped, read-only access to a PsuBinaryLog file.
+    
+    The records are sorted by time, so range() finds the records between two
+    times with a binary search instead of scanning the file.
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path, "rb") as file:
+            self.header = readLogHeader(file.read(LOG_HEADER.size))
+            size = os.fstat(file.fileno()).st_size
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.offset = self.header["headerSize"]
+        self.recordSize = self.header["recordSize"]
+        self.count = (len(self.map) - self.offset) // self.recordSize
+        self.channel = self.header["channel"]
+    
+    def __len__(self):
+        return self.count
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+    
+    def record(self, index):
+        return LOG_RECORD.unpack_from(self.map, self.offset + index * self.recordSize)
+    
+    def timeAt(self, index):
+        return struct.unpack_from("<d", self.map, self.offset + index * self.recordSize)[0]
+    
+    def lastTime(self):
+        return self.timeAt(self.count - 1) if self.count else None
+    
+    def bisect(self, t):
+        # Index of the first record at or after t
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.timeAt(mid) < t:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+    
+    def range(self, t0=None, t1=None):
+        start = 0 if t0 is None else self.bisect(t0)
+        stop = self.count if t1 is None else self.bisect(t1)
+        return start, max(start, stop)
+    
+    def records(self, t0=None, t1=None):
+        start, stop = self.range(t0, t1)
+        for index in range(start, stop):
+            yield self.record(index)
+    
+    def toCsv(self, path, t0=None, t1=None):
+        with open(path, "w", newline="") as file:
+            file.write(",".join(PsuSampleBuffer.fields) + "\n")
+            for t, voltage, current, status in self.records(t0, t1):
+                file.write("{!r},{!r},{!r},{:d}\n".format(t, voltage, current, int(status)))
+        return path
+
+def readLogHeader(data):
+    if len(data) < LOG_HEADER.size:
+        raise printableError("Not a PSU log file: header is incomplete")
+    magic, version, headerSize, recordSize, channel, created, layout, units = LOG_HEADER.unpack(data)
+    if magic != LOG_MAGIC or version != 1:
+        raise printableError("Not a PSU log file or unknown version")
+    return {
+        "version": version,
+        "headerSize": headerSize,
+        "recordSize": recordSize,
+        "channel": channel,
+        "created": created,
+        "layout": layout.rstrip(b"\0").decode("ascii"),
+        "units": units.rstrip(b"\0").decode("ascii"),
+    }
+
+def binaryLogToCsv(source, target=None, t0=None, t1=None):
+    source = pathlib.Path(source)
+    target = source.with_suffix(".csv") if target is None else target
+    with PsuBinaryLogReader(source) as reader:
+        return reader.toCsv(target, t0, t1)
+
+class PsuFrameParser:
+    """Incremental splitter for the \\n\\r\\x04 terminated device answers.
+    
+    Received bytes are appended to one bytearray. Complete frames are cut out
+    in place, a trailing partial frame stays in the buffer for the next feed.
+    The consumed prefix is only removed once it is worth the move.
+    """
+    def __init__(self, terminator=FRAME_TERMINATOR):
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self.start = 0
+        self.scan = 0
+    
+    def feed(self, data):
+        self.buffer += data
+        return self
+    
+    def nextFrame(self):
+        end = self.buffer.find(self.terminator, self.scan)
+        if end < 0:
+            # Resume the search where a terminator could still begin
+            self.scan = max(len(self.buffer) - len(self.terminator) + 1, self.start)
+            return None
+        with memoryview(self.buffer) as view:
+            frame = bytes(view[self.start:end])
+        self.start = self.scan = end + len(self.terminator)
+        if self.start == len(self.buffer) or self.start > 4096:
+            del self.buffer[:self.start]
+            self.scan -= self.start
+            self.start = 0
+        return frame
+    
+    def pending(self):
+        return len(self.buffer) - self.start
+    
+    def clear(self):
+        dropped = self.pending()
+        self.buffer.clear()
+        self.start = self.scan = 0
+        return dropped
+
+class PsuBatch:
+    """Collects commands and queries for one PsuControlCom.
+    
+    On execute all lines are sent back-to-back before the responses are read in
+    order, so the device does not wait for a round trip between queries. At
+    most pipelineDepth queries are outstanding at the same time. The answers of
+    a chunk are only applied once all of them arrived.
+    """
+    pipelineDepth = 8
+    
+    def __init__(self, com):
+        self.com = com
+        self.steps = []
+    
+    def write(self, *commands):
+        self.steps.append((commands, None, None))
+        return self
+    
+    def query(self, apply, convert, *commands):
+        self.steps.append((commands, apply, convert))
+        return self
+    
+    def execute(self):
+        with self.com.bus.lock:
+            return self._execute()
+    
+    def _execute(self):
+        for chunk in self.chunks():
+            for commands, apply, values in self.exchange(chunk):
+                apply(*values)
+        self.com.commitSample()
+        return self.com
+    
+    def chunks(self):
+        steps, self.steps = self.steps, []
+        while steps:
+            chunk, queries = [], 0
+            while steps and (queries < self.pipelineDepth or steps[0][1] is None):
+                step = steps.pop(0)
+                chunk.append(step)
+                if step[1] is not None:
+                    queries += len(step[0])
+            yield chunk
+    
+    def exchange(self, chunk):
+        # If a frame goes missing there is no telling which answer of the chunk
+        # was lost, and the answers after it are shifted (which often shows as
+        # an answer that does not parse). Nothing is applied then and the
+        # whole chunk is sent once more.
+        for attempt in range(2):
+            self.com.write(*[command for step in chunk for command in step[0]])
+            try:
+                return [(commands, apply, [convert(self.com.read(command)) for command in commands])
+                        for commands, apply, convert in chunk if apply is not None]
+            except (missingFrameError, ValueError):
+                if attempt:
+                    raise
+                self.com.bus.metrics.retries += 1
+                if TRACE.level:
+                    TRACE.event(PsuTrace.RETRY, self.com.channel, chunk[0][0][0], 0, 0)
+
+class PsuBus:
+    """One serial port shared by all channels of a multidrop RS232 bus.
+    
+    The bus keeps track of the channel the interface is addressed to, so the
+    PsuControlCom views on it only send CH when the channel really changes.
+    All transactions hold the lock, a batch holds it while it runs. Lines
+    passed to urgent skip all of that, see there. The port is opened with the
+    short readInterval as its timeout, which is never changed afterwards
+    (setting it reconfigures the port on Windows), reads wait for their
+    deadline in steps of it.
+    """
+    readInterval = 0.005
+    
+    def __init__(self):
+        self.serialConnection = None
+        self.port = None
+        self.baudrate = 9600
+        self.activeChannel = None
+        self.generation = 0
+        self.lock = threading.RLock()
         self.readErrorCount = 0
+        self.latency = PsuLatencyTracker()
+        self.writeTime = 0
+        self.frameTime = 0
+        self.parser = PsuFrameParser()
+        self.outstanding = 0
+        self.strayCount = 0
+        self.metrics = PsuMetrics()
+        self.urgentLines = deque()
+        # (addresses, found) of the scan PsuLinkNegotiator did on this link
+        self.probed = None
     
     def __del__(self):
         if self.serialConnection is not None:
             self.serialConnection.close()
     
-    def write(self, command):
-        print("Sending:", command)
+    def write(self, *commands):
+        with self.lock:
+            return self._write(commands)
+    
+    def _write(self, commands):
         self.checkConnection(1)
+        self.dropStray()
+        commands, urgent = self.takeUrgent(commands)
+        data = self.encode(commands)
+        started = monotonic()
+        self.metrics.begin(started)
         try:
-            self.serialConnection.write("{}\n".format(command).encode("utf-8"))
+            self.serialConnection.write(data)
         except serial.serialutil.SerialException as err:
-            self.serialConnection.close()
-            self.serialConnection = None
-            raise printableError("{}\nClosing connection".format(err))
+            self.metrics.end(monotonic())
+            self.fault(commands[0], err)
+        self.written(commands, data, started)
+        for done in urgent:
+            done(self.writeTime)
         return self
     
-    def read(self, delay=None):
+    def urgent(self, channel, commands, done=None):
+        # Priority lane for commands that must not wait, like a shutdown. They
+        # go out right away if the bus is free, otherwise in front of the next
+        # write of whoever holds the lock, which is at most one batch chunk
+        # away. done(writeTime) is called once they are sent.
+        self.urgentLines.append((channel, tuple(commands), done))
+        if self.lock.acquire(blocking=False):
+            try:
+                self.sendUrgent()
+            finally:
+                self.lock.release()
+        else:
+            # In case the holder is done before it writes again
+            threading.Thread(target=self.sendUrgent, name="PsuUrgent", daemon=True).start()
+        return self
+    
+    def sendUrgent(self):
+        with self.lock:
+            if self.urgentLines and self.is_connected():
+                try:
+                    self._write(())
+                except printableError as err:
+                    print("Urgent write failed:", err, file=sys.stderr)
+    
+    def takeUrgent(self, commands):
+        # Urgent lines are put in front, afterwards the channel that was
+        # addressed is addressed again, so the rest does not notice.
+        if not self.urgentLines:
+            return commands, ()
+        lines, callbacks = [], []
+        previous = active = self.activeChannel
+        while self.urgentLines:
+            channel, urgent, done = self.urgentLines.popleft()
+            if active != channel:
+                lines.append("CH {}".format(channel))
+                active = channel
+            lines += urgent
+            if done is not None:
+                callbacks.append(done)
+        if previous is not None and active != previous and not (commands and commands[0].startswith("CH ")):
+            lines.append("CH {}".format(previous))
+        self.metrics.urgentWrites += 1
+        return tuple(lines) + tuple(commands), callbacks
+    
+    @staticmethod
+    def encode(commands):
+        return "".join("{}\n".format(command) for command in commands).encode("utf-8")
+    
+    def written(self, commands, data, started):
+        # Bookkeeping once data went out, shared with the asyncio transport
+        metrics = self.metrics
+        self.writeTime = monotonic()
+        metrics.bytesSent += len(data)
+        for command in commands:
+            if command.endswith("?"):
+                self.outstanding += 1
+            elif command.startswith("CH "):
+                if self.activeChannel != int(command[3:]):
+                    metrics.channelSwitches += 1
+                self.activeChannel = int(command[3:])
+        trace = TRACE
+        if trace.level:
+            trace.event(PsuTrace.WRITE, self.activeChannel, commands[0], self.writeTime - started, len(data))
+        if not self.outstanding:
+            # Nothing to wait for, the bus is busy until the line is sent
+            metrics.end(self.writeTime + len(data) * 10 / self.serialConnection.baudrate)
+        return self
+    
+    def fault(self, command, err):
+        self.serialConnection.close()
+        self.serialConnection = None
+        TRACE.fault(PsuTrace.ERROR, self.activeChannel, command, err)
+        raise printableError("{}\nClosing connection".format(err))
+    
+    def dropStray(self):
+        # Answers to queries that were never read (timed out or abandoned after
+        # an error) may still arrive. They are waited for until the longest
+        # possible answer time has passed, so none of them can be taken for the
+        # answer to the next query. This only costs time after an error.
+        try:
+            if self.outstanding:
+                deadline = self.strayDeadline()
+                while self.outstanding:
+                    frame = self.readFrame(deadline)
+                    if frame is None:
+                        break
+                    self.dropFrame(frame)
+                self.outstanding = 0
+            self.receive()
+        except serial.serialutil.SerialException:
+            return
+        self.dropRest()
+    
+    def strayDeadline(self):
+        return max(self.writeTime, self.frameTime) + self.latency.measureTimeout
+    
+    def dropFrame(self, frame):
+        self.outstanding -= 1
+        self.strayCount += 1
+        TRACE.log(TRACE_PRINT, "Dropped stale frame: {!r}", frame)
+        if TRACE.level:
+            TRACE.event(PsuTrace.STRAY, self.activeChannel, "", 0, len(frame))
+    
+    def dropRest(self):
+        while self.parser.nextFrame() is not None:
+            self.strayCount += 1
+        dropped = self.parser.clear()
+        if dropped:
+            self.strayCount += 1
+            TRACE.log(TRACE_PRINT, "Dropped {} stray bytes", dropped)
+            if TRACE.level:
+                TRACE.event(PsuTrace.STRAY, self.activeChannel, "", 0, dropped)
+    
+    def receive(self, timeout=0):
+        # Drains everything the port holds. With a timeout it first blocks for
+        # at most readInterval until one byte arrives, readFrame calls again
+        # until its deadline passed.
+        con = self.serialConnection
+        received = 0
+        if timeout > 0 and not con.in_waiting:
+            data = con.read(1)
+            if not data:
+                return 0
+            self.parser.feed(data)
+            received = 1
+        waiting = con.in_waiting
+        if waiting:
+            self.parser.feed(con.read(waiting))
+            received += waiting
+        self.metrics.bytesReceived += received
+        return received
+    
+    def read(self, command=""):
+        with self.lock:
+            return self._read(command)
+    
+    def _read(self, command):
         self.checkConnection(0)
-        if delay is not None:
-            sleep(delay)
-            self.checkConnection(0)
+        key = self.latency.key(command)
+        # Pipelined answers queue up behind each other, so the latency counts
+        # from whatever happened last: the write or the previous frame.
+        start = max(self.writeTime, self.frameTime)
         try:
-            # TODO Fix expected to \n\r\x04
-            # ValueError: invalid literal for int() with base 10: '1\n\r\x04'
-            data = self.serialConnection.read_until(expected="\x04").decode("utf-8")
-            print(repr(data))
-            data = data.replace("\n","").replace("\r","").replace("\04","")
-            #data = data[:-3]
+            frame = self.readFrame(start + self.latency.timeout(key))
+            if frame is None and self.parser.pending():
+                # Something arrived in time, the frame is just slow
+                frame = self.readFrame(start + self.latency.hardTimeout(key))
         except serial.serialutil.SerialException as err:
-            self.serialConnection.close()
-            self.serialConnection = None
-            raise printableError("{}\nClosing connection".format(err))
-        print("Received:", data)
-        if data is None or data == "":
+            self.fault(command, err)
+        return self.answer(command, key, start, frame)
+    
+    def answer(self, command, key, start, frame):
+        # Bookkeeping once a frame arrived or timed out, shared with the
+        # asyncio transport
+        if frame is None:
+            if TRACE.level:
+                TRACE.event(PsuTrace.TIMEOUT, self.activeChannel, command, monotonic() - start, self.parser.pending())
+            # The device may have missed the channel switch as well
+            self.activeChannel = None
+            self.metrics.timeout(key, monotonic())
             self.readErrorCount += 1
             if self.readErrorCount >= 3:
                 self.serialConnection.close()
                 self.serialConnection = None
+                TRACE.fault(PsuTrace.ERROR, None, command, "read failed too often")
                 raise printableError("Could not read from serial interface too often!\nClosing Connection")
             else:
-                raise printableError("Could not read from serial interface")
+                raise missingFrameError("Could not read from serial interface")
+        self.outstanding = max(self.outstanding - 1, 0)
+        self.frameTime = monotonic()
+        self.latency.record(key, self.frameTime - start)
+        self.metrics.observe(key, self.frameTime - start)
+        if not self.outstanding:
+            self.metrics.end(self.frameTime)
+        trace = TRACE
+        if trace.level:
+            trace.event(PsuTrace.READ, self.activeChannel, command, self.frameTime - start, len(frame))
+            if trace.level >= TRACE_PRINT:
+                trace.log(TRACE_PRINT, "Received: {!r}", frame)
+        data = frame.decode("utf-8").strip()
         self.readErrorCount = 0
         return data
     
+    def readFrame(self, deadline):
+        while True:
+            frame = self.parser.nextFrame()
+            if frame is not None:
+                return frame
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            self.receive(remaining)
+    
+    def scan(self, addresses=range(1, 30), chunk=None):
+        # Probes the addresses with CH n and CH?, chunk of them in one write.
+        # Only present supplies answer, and since the answer is the address, it
+        # does not matter which ones stay silent. Returns the addresses found.
+        addresses = list(addresses)
+        chunk = PsuBatch.pipelineDepth if chunk is None else chunk
+        key = self.latency.key("CH?")
+        found = set()
+        with self.lock:
+            for i in range(0, len(addresses), chunk):
+                commands = []
+                for address in addresses[i:i + chunk]:
+                    commands += ["CH {}".format(address), "CH?"]
+                self._write(commands)
+                # The answers come after the whole chunk went over the line at the latest
+                sent = self.writeTime + len(self.encode(commands)) * 10 / self.serialConnection.baudrate
+                while True:
+                    frame = self.readFrame(max(sent, self.frameTime) + self.latency.hardTimeout(key))
+                    if frame is None:
+                        break
+                    self.frameTime = monotonic()
+                    try:
+                        found.add(int(frame.decode("utf-8").strip()))
+                    except ValueError:
+                        self.strayCount += 1
+                self.outstanding = 0
+            self.metrics.end(monotonic())
+            self.activeChannel = None
+        return sorted(found.intersection(addresses))
+    
     def close(self):
-        self.serialConnection.close()
+        if self.serialConnection is not None:
+            self.serialConnection.close()
         self.serialConnection = None
+        self.activeChannel = None
     
     def open(self, port, baudrate=9600):
-        if self.serialConnection is not None:
-            self.serialConnection.close()
-            self.serialConnection = None
-        
+        self.close()
         try:
-            self.serialConnection = serial.Serial(port=port, baudrate=baudrate, timeout=0.2, writeTimeout=5)
+            # URLs like psusim:// or socket:// are opened by the pyserial handler of their scheme
+            self.serialConnection = serial.serial_for_url(port, baudrate=baudrate, timeout=self.readInterval,
+                                                          writeTimeout=5)
             if not self.serialConnection.is_open:
                 self.serialConnection.open()
-        except serial.SerialException:
-            self.serialConnection.close()
+        except (serial.SerialException, ValueError):
+            self.close()
             raise printableError("The serial connection could not be established, because either\nthe device was not found or could not be configured.")
         else:
             self.readErrorCount = 0
+            self.latency = PsuLatencyTracker.forLink(baudrate)
+            self.parser.clear()
+            self.outstanding = 0
+            self.activeChannel = None
+            self.probed = None
+            self.port = port
+            self.baudrate = baudrate
+            self.generation += 1
             return self
     
+    def connect(self, port, baudrate=None, adapter=None):
+        # Opens port at baudrate, without one at the rate PsuLinkNegotiator
+        # remembers or finds for it
+        if baudrate is not None:
+            return self.open(port, baudrate)
+        PsuLinkNegotiator().negotiate(self, port, adapter)
+        return self
+    
     def is_connected(self, val=-1):
         if self.serialConnection is not None:
             if self.serialConnection.is_open:
@@ -127,7 +1133,119 @@ class PsuControlCom:
             if not self.is_connected(val):
                 raise printableError("Connection is not avialable or is faulty!\nPlease check connection.")
     
+
+class PsuInterlock:
+    """Limits of one channel, checked against every new measurement.
+    
+    maxVoltage, maxCurrent and maxPower are in V, A and W, the rate limits in
+    V/s and A/s between two samples. On a violation RSD 1 and OUTP OFF go out
+    through the urgent lane of the bus, ahead of all queued traffic. Every trip
+    is kept in trips, with the time from the sample to the shutdown write.
+    """
+    shutdownCommands = ("SOurce:FUnction:RSD 1", "SOurce:FUnction:OUTP OFF")
+    
+    def __init__(self, maxVoltage=None, maxCurrent=None, maxPower=None, maxVoltageRate=None, maxCurrentRate=None,
+                 onTrip=None):
+        self.maxVoltage = maxVoltage
+        self.maxCurrent = maxCurrent
+        self.maxPower = maxPower
+        self.maxVoltageRate = maxVoltageRate
+        self.maxCurrentRate = maxCurrentRate
+        self.onTrip = onTrip
+        self.previous = None
+        self.trips = deque(maxlen=100)
+    
+    def violation(self, sampleTime, voltage, current):
+        checks = [("voltage", voltage, self.maxVoltage),
+                  ("current", current, self.maxCurrent),
+                  ("power", voltage * current, self.maxPower)]
+        if self.previous is not None and sampleTime > self.previous[0]:
+            elapsed = sampleTime - self.previous[0]
+            checks.append(("voltage rate", abs(voltage - self.previous[1]) / elapsed, self.maxVoltageRate))
+            checks.append(("current rate", abs(current - self.previous[2]) / elapsed, self.maxCurrentRate))
+        for reason, value, limit in checks:
+            if limit is not None and value > limit:
+                return reason, value, limit
+        return None
+    
+    def check(self, com, sampleTime, voltage, current, status):
+        # Measured values are -1 while the output is off
+        if status != 0 or voltage is None or current is None or voltage < 0 or current < 0:
+            self.previous = None
+            return None
+        violation = self.violation(sampleTime, voltage, current)
+        self.previous = (sampleTime, voltage, current)
+        if violation is not None:
+            self.trip(com, sampleTime, *violation)
+        return violation
+    
+    def trip(self, com, sampleTime, reason, value, limit):
+        trip = {"time": sampleTime, "channel": com.channel, "reason": reason, "value": value, "limit": limit,
+                "latency": None}
+        self.trips.append(trip)
+        self.previous = None
+        def done(writeTime):
+            trip["latency"] = writeTime - sampleTime
+            # On stderr, stdout may carry the samples of cliPoll
+            print("Interlock CH {}: {} {:.4g} over {:.4g}, output off after {:.1f} ms".format(
+                com.channel, reason, value, limit, trip["latency"] * 1e3), file=sys.stderr)
+            if self.onTrip is not None:
+                self.onTrip(com, trip)
+        com.bus.urgent(com.channel, self.shutdownCommands, done)
+        return trip
+
+class PsuControlCom:
+    sampleCapacity = 36000
+    
+    def __init__(self, channel=1, bus=None):
+        self.status     = -1
+        self.isRemote   = -1
+        self.frontpanel = -1
+        self.voltageSet = None
+        self.currentSet = None
+        self.voltageMeasured = None
+        self.currentMeasured = None
+        self.voltageMax = 0
+        self.currentMax = 0
+        self.voltageRequested = None
+        self.currentRequested = None
+        self.identification = None
+        self.bus = PsuBus() if bus is None else bus
+        self.channel = channel
+        self.cache = PsuParamCache()
+        self.samples = PsuSampleBuffer(self.sampleCapacity)
+        self.samplePending = False
+        self.interlock = None
+    
+    @property
+    def serialConnection(self):
+        return self.bus.serialConnection
+    
+    def write(self, *commands):
+        with self.bus.lock:
+            if self.bus.activeChannel != self.channel and not commands[0].startswith("CH "):
+                commands = ("CH {}".format(self.channel),) + commands
+            self.bus.write(*commands)
+        return self
+    
+    def read(self, command=""):
+        return self.bus.read(command)
+    
+    def close(self):
+        self.bus.close()
+    
+    def open(self, port, baudrate=9600):
+        self.bus.open(port, baudrate)
+        return self
+    
+    def is_connected(self, val=-1):
+        return self.bus.is_connected(val)
+    
+    def checkConnection(self, val=-1):
+        self.bus.checkConnection(val)
+    
     def initialCom(self):
+        self.cache.clear()
         for _ in range(5):
             try:
                 self.setChannel(self.channel).updateStatus()
@@ -138,88 +1256,219 @@ class PsuControlCom:
                 continue
             else:
                 break
-        self.updateRemoteStatus() \
-            .updateMaxValues() \
-            .updateSetCurrent() \
-            .updateSetVoltage() \
-            .updateFrontpanelStatus()\
-            .updateMeasuredCurrent() \
-            .updateMeasuredVoltage()
+        batch = self.batch()
+        self.updateRemoteStatus(batch) \
+            .updateMaxValues(batch) \
+            .updateSetCurrent(batch) \
+            .updateSetVoltage(batch) \
+            .updateFrontpanelStatus(batch)\
+            .updateMeasuredCurrent(batch) \
+            .updateMeasuredVoltage(batch)
+        batch.execute()
         return self
     
-    def saveUpdate(self):
-        self.setChannel(self.channel)
-        self.updateStatus() \
-            .updateRemoteStatus() \
-            .updateMaxValues() \
-            .updateSetCurrent() \
-            .updateSetVoltage()
-        return self
+    def warmState(self):
+        # What warmCom needs to skip initialCom in the next session
+        return {
+            "voltageMax": self.voltageMax,
+            "currentMax": self.currentMax,
+            "voltageSet": self.voltageSet,
+            "currentSet": self.currentSet,
+            "isRemote": self.isRemote,
+            "identification": self.identification,
+        }
     
-    def fullUpdate(self):
-        self.saveUpdate() \
-            .updateMeasuredCurrent() \
-            .updateMeasuredVoltage()
-        return self
+    def warmCom(self, state):
+        # Instead of initialCom: takes state from warmState of an earlier
+        # session and only checks its fingerprint, the maximum values,
+        # setpoints and remote mode, in one batch with the status. Returns
+        # whether it matched, if not (or nothing answers) initialCom runs
+        # after all.
+        self.cache.clear()
+        answers = {}
+        batch = self.batch()
+        self.setChannel(self.channel, batch).updateStatus(batch)
+        self.query(batch, lambda *values: answers.update(max=values), float, "SOur:VOlt:MAx?", "SOur:CUrr:MAx?")
+        self.query(batch, lambda *values: answers.update(setpoints=values), float, "SOurce:VOltage?", "SOurce:CUrrent?")
+        self.query(batch, lambda *values: answers.update(remote=values), int, "REMote:CV?", "REMote:CC?")
+        try:
+            batch.execute()
+        except missingFrameError:
+            self.initialCom()
+            return False
+        voltageMax, currentMax = answers["max"]
+        voltageSet, currentSet = answers["setpoints"]
+        remCV, remCC = answers["remote"]
+        matches = (state.get("voltageMax") == voltageMax and state.get("currentMax") == currentMax
+                   and state.get("voltageSet") is not None and state.get("currentSet") is not None
+                   and abs(voltageSet - state["voltageSet"]) < 1e-6 and abs(currentSet - state["currentSet"]) < 1e-6
+                   and remCV * remCC == state.get("isRemote"))
+        if not matches or not voltageMax:
+            self.initialCom()
+            return False
+        self.cache.generation(self.bus.generation)
+        self.voltageMax, self.currentMax = voltageMax, currentMax
+        self.identification = state.get("identification")
+        self.voltageSet, self.currentSet = voltageSet, currentSet
+        self.isRemote = remCV * remCC
+        self.cache.put("max", (self.voltageMax, self.currentMax))
+        self.cache.put("voltageSet", (voltageSet,))
+        self.cache.put("currentSet", (currentSet,))
+        self.cache.put("remote", (remCV, remCC))
+        return True
     
-    def setChannel(self, channel):
-        if not 0 < channel < 30:
-            raise Exception("Communication channel is not within range! (0<channel<30)")
-        self.write("CH {}".format(channel))
-        self.readChannel()
+    def saveUpdate(self, batch=None):
+        own = batch is None
+        if own:
+            batch = self.batch()
+        self.setChannel(self.channel, batch) \
+            .updateStatus(batch) \
+            .updateRemoteStatus(batch) \
+            .updateMaxValues(batch) \
+            .updateSetCurrent(batch) \
+            .updateSetVoltage(batch)
+        if own:
+            batch.execute()
         return self
     
-    def readChannel(self):
-        self.channel = int(self.write("CH?").read())
+    def fullUpdate(self, batch=None):
+        own = batch is None
+        if own:
+            batch = self.batch()
+        self.saveUpdate(batch) \
+            .updateMeasuredCurrent(batch) \
+            .updateMeasuredVoltage(batch)
+        if own:
+            batch.execute()
         return self
     
-    def updateStatus(self):
-        rsd = int(self.write("SOurce:FUnction:RSD?").read())
-        power = int(self.write("SOurce:FUnction:OUTP?").read())
-        self.status = 0 if (rsd == 0 and power==1) else 1
-        return self
+    def batch(self):
+        return PsuBatch(self)
     
-    def updateRemoteStatus(self):
-        remCV = int(self.write("REMote:CV?").read())
-        remCC = int(self.write("REMote:CC?").read())
-        self.isRemote = remCV * remCC
+    def query(self, batch, apply, convert, *commands, cache=None):
+        # Adds the queries to batch, or runs them right away if there is none
+        if cache is not None:
+            self.cache.generation(self.bus.generation)
+            hit, values = self.cache.get(cache)
+            if hit:
+                apply(*values)
+                return self
+            uncached = apply
+            def apply(*values):
+                self.cache.put(cache, values)
+                uncached(*values)
+        if batch is None:
+            PsuBatch(self).query(apply, convert, *commands).execute()
+        else:
+            batch.query(apply, convert, *commands)
         return self
     
-    def updateMaxValues(self):
-        self.voltageMax = float(self.write("SOur:VOlt:MAx?").read())
-        self.currentMax = float(self.write("SOur:CUrr:MAx?").read())
+    def command(self, batch, *commands):
+        if batch is None:
+            self.write(*commands)
+        else:
+            batch.write(*commands)
         return self
     
-    def updateSetCurrent(self):
-        self.currentSet = float(self.write("SOurce:CUrrent?").read())
+    def setChannel(self, channel, batch=None):
+        if not 0 < channel < 30:
+            raise Exception("Communication channel is not within range! (0<channel<30)")
+        if self.bus.activeChannel == channel == self.channel:
+            return self
+        self.command(batch, "CH {}".format(channel))
+        self.readChannel(batch)
         return self
     
-    def updateSetVoltage(self):
-        self.voltageSet = float(self.write("SOurce:VOltage?").read())
-        return self
+    def readChannel(self, batch=None):
+        def apply(channel):
+            self.channel = self.bus.activeChannel = channel
+        return self.query(batch, apply, int, "CH?")
     
-    def updateMeasuredCurrent(self):
-        if self.status == 0:
-            self.currentMeasured = float(self.write("MEasure:CUrrent?").read(0.5))
-        else:
-            self.currentMeasured = -1
+    def updateStatus(self, batch=None):
+        def apply(rsd, power):
+            self.status = 0 if (rsd == 0 and power==1) else 1
+        return self.query(batch, apply, int, "SOurce:FUnction:RSD?", "SOurce:FUnction:OUTP?")
+    
+    def updateRemoteStatus(self, batch=None):
+        def apply(remCV, remCC):
+            self.isRemote = remCV * remCC
+        return self.query(batch, apply, int, "REMote:CV?", "REMote:CC?", cache="remote")
+    
+    def updateMaxValues(self, batch=None):
+        def apply(voltageMax, currentMax):
+            self.voltageMax = voltageMax
+            self.currentMax = currentMax
+        return self.query(batch, apply, float, "SOur:VOlt:MAx?", "SOur:CUrr:MAx?", cache="max")
+    
+    def updateIdentification(self, batch=None):
+        def apply(identification):
+            self.identification = identification
+        return self.query(batch, apply, str, "*IDN?", cache="identification")
+    
+    def updateSetCurrent(self, batch=None):
+        def apply(currentSet):
+            self.currentSet = currentSet
+        return self.query(batch, apply, float, "SOurce:CUrrent?", cache="currentSet")
+    
+    def updateSetVoltage(self, batch=None):
+        def apply(voltageSet):
+            self.voltageSet = voltageSet
+        return self.query(batch, apply, float, "SOurce:VOltage?", cache="voltageSet")
+    
+    def updateMeasuredCurrent(self, batch=None):
+        # MEasure is slow, so it is skipped while the output is known to be
+        # off. Inside a batch a status that is not known yet may be read by the
+        # batch, the decision is made when the answer is applied then.
+        def apply(currentMeasured):
+            self.currentMeasured = currentMeasured if self.status == 0 else -1
+            self.samplePending = True
+        if self.status == 1 or batch is None and self.status != 0:
+            apply(-1)
+            return self.commitSample() if batch is None else self
+        return self.query(batch, apply, float, "MEasure:CUrrent?")
+    
+    def updateMeasuredVoltage(self, batch=None):
+        def apply(voltageMeasured):
+            self.voltageMeasured = voltageMeasured if self.status == 0 else -1
+            self.samplePending = True
+        if self.status == 1 or batch is None and self.status != 0:
+            apply(-1)
+            return self.commitSample() if batch is None else self
+        return self.query(batch, apply, float, "MEasure:VOltage?")
+    
+    def logTo(self, directory, chunk=256):
+        self.stopLog()
+        self.samples.writer = PsuBinaryLog(PsuBinaryLog.pathFor(directory, self.channel), self.channel, chunk)
         return self
     
-    def updateMeasuredVoltage(self):
-        if self.status == 0:
-            self.voltageMeasured = float(self.write("MEasure:VOltage?").read(0.5))
-        else:
-            self.voltageMeasured = -1
+    def stopLog(self):
+        if self.samples.writer is not None:
+            self.samples.writer.close()
+            self.samples.writer = None
         return self
     
-    def setVoltage(self):
-        self.write("SOurce:VOltage {}".format(self.voltageRequested))
+    def commitSample(self):
+        # One sample per batch, even if it measured voltage and current
+        if self.samplePending:
+            self.samplePending = False
+            sampleTime = monotonic()
+            self.samples.append(sampleTime, self.voltageMeasured, self.currentMeasured, self.status)
+            if self.interlock is not None:
+                self.interlock.check(self, sampleTime, self.voltageMeasured, self.currentMeasured, self.status)
         return self
     
-    def setCurrent(self):
-        self.write("SOurce:CUrrent {}".format(self.currentRequested))
+    def setInterlock(self, interlock):
+        self.interlock = interlock
         return self
     
+    def setVoltage(self, batch=None):
+        self.cache.invalidate("voltageSet")
+        return self.command(batch, "SOurce:VOltage {}".format(self.voltageRequested))
+    
+    def setCurrent(self, batch=None):
+        self.cache.invalidate("currentSet")
+        return self.command(batch, "SOurce:CUrrent {}".format(self.currentRequested))
+    
     def voltageRequestedSet(self, val):
         if self.voltageMax < val:
             raise printableError("Voltage is not in range.\nMax Voltage is {} V".format(self.voltageMax))
@@ -236,31 +1485,53 @@ class PsuControlCom:
         self.currentRequested = val
         return self
     
-    def psuOn(self):
-        self.write("SOurce:FUnction:RSD 0")
-        self.write("SOurce:FUnction:OUTP ON")
-        self.updateStatus()
+    def psuOn(self, batch=None):
+        own = batch is None
+        if own:
+            batch = self.batch()
+        batch.write("SOurce:FUnction:RSD 0", "SOurce:FUnction:OUTP ON")
+        self.updateStatus(batch)
+        if own:
+            batch.execute()
         return self
     
-    def psuOff(self):
-        self.write("SOurce:FUnction:RSD 1")
-        self.write("SOurce:FUnction:OUTP OFF")
-        self.updateStatus()
+    def psuOff(self, batch=None):
+        own = batch is None
+        if own:
+            batch = self.batch()
+        batch.write("SOurce:FUnction:RSD 1", "SOurce:FUnction:OUTP OFF")
+        self.updateStatus(batch)
+        if own:
+            batch.execute()
         return self
     
-    def psuRemote(self):
-        self.write("REMote:CC").write("REMote:CV").updateRemoteStatus()
-        self.write("SOurce:FUnction:OUTP ON")
-        self.updateStatus()
+    def psuRemote(self, batch=None):
+        own = batch is None
+        if own:
+            batch = self.batch()
+        self.cache.invalidate("remote")
+        batch.write("REMote:CC", "REMote:CV")
+        self.updateRemoteStatus(batch)
+        batch.write("SOurce:FUnction:OUTP ON")
+        self.updateStatus(batch)
+        if own:
+            batch.execute()
         return self
     
-    def psuLocal(self):
-        self.write("LOCal:CC").write("LOCal:CV").updateRemoteStatus()
-        self.write("SOurce:FUnction:OUTP ON")
-        self.updateStatus()
+    def psuLocal(self, batch=None):
+        own = batch is None
+        if own:
+            batch = self.batch()
+        self.cache.invalidate("remote")
+        batch.write("LOCal:CC", "LOCal:CV")
+        self.updateRemoteStatus(batch)
+        batch.write("SOurce:FUnction:OUTP ON")
+        self.updateStatus(batch)
+        if own:
+            batch.execute()
         return self
     
-    def updateFrontpanelStatus(self):
+    def updateFrontpanelStatus(self, batch=None):
         #self.frontpanel = int(self.write("SOurce:FUnction:FRontpanel:Lock?").read())
         return self
     
@@ -271,415 +1542,822 @@ class PsuControlCom:
     def fpUnlock(self):
         #self.write("SOurce:FUnction:FRontpanel:Lock Unlock").updateFrontpanelStatus()
         return self
-
-class PsuControlApp:
-    def __init__(self, master=None):
-        self.builder = builder = pygubu.Builder()
-        builder.add_resource_path(PROJECT_PATH)
-        builder.add_from_file(PROJECT_UI)
-        self.mainwindow = builder.get_object('mainwindow', master)
-        self.img_Icon = tk.PhotoImage(file=ICON_PATH)
-        self.mainwindow.iconphoto(True, self.img_Icon)
-        
-        self.userSetVoltage = None
-        self.userSetCurrent = None
-        self.errorMsg = None
-        self.selectedChannel = 0
-        self.selectedChannelTxt = None
-        builder.import_variables(
-            self, ["userSetVoltage", "userSetCurrent", "errorMsg", "selectedChannel", "selectedChannelTxt",]
-        )
-        
-        builder.connect_callbacks(self)
-        
-        self.dialogLocal  = None
-        self.initDialogLocal(self.mainwindow)
-        self.dialogRemote = None
-        self.initDialogRemote(self.mainwindow)
-        
-        self.selectedPort = 1
-        self.coms= [PsuControlCom(i) for i in range(1,16)]
-        self.com = self.coms[0]
-    
-    def initDialogLocal(self, master):
-        # build ui
-        self.dialogLocal = tk.Tk() if master is None else tk.Toplevel(master)
-        self.message9 = tk.Message(self.dialogLocal)
-        self.message9.configure(font='TkDefaultFont', text='Are you shure you want to switch to the local settings?\n\nWARNING: The power supply will return to the potentiometers settings on the front panel!', width='350')
-        self.message9.grid(column='0', columnspan='2', padx='10', pady='10', row='0')
-        self.dialogLocal.columnconfigure('0', pad='20')
-        self.buttonLocalConfirm = ttk.Button(self.dialogLocal)
-        self.buttonLocalConfirm.configure(takefocus=True, text='Confirm')
-        self.buttonLocalConfirm.grid(column='0', row='1')
-        self.dialogLocal.rowconfigure('1', pad='30')
-        self.buttonLocalConfirm.configure(command=self.psuLocal)
-        self.button12 = ttk.Button(self.dialogLocal)
-        self.button12.configure(takefocus=True, text='Abort')
-        self.button12.grid(column='1', row='1')
-        self.dialogLocal.columnconfigure('1', pad='20')
-        self.button12.configure(command=self.psuLocalDialogClose)
-        self.dialogLocal.configure(height='200', width='200')
-        self.dialogLocal.title('Switch to Local?')
-        self.dialogLocal.withdraw()
-    
-    def initDialogRemote(self, master):
-        # build ui
-        self.dialogRemote = tk.Tk() if master is None else tk.Toplevel(master)
-        self.message10 = tk.Message(self.dialogRemote)
-        self.message10.configure(font='TkDefaultFont', justify='left', text='Are you shure you want to switch to the remote settings?\n\nWARNING: The power supply will return to the set Voltage and Current!', width='350')
-        self.message10.grid(column='0', columnspan='2', ipadx='10', ipady='10', row='0')
-        self.dialogRemote.columnconfigure('0', pad='20')
-        self.button13 = ttk.Button(self.dialogRemote)
-        self.button13.configure(takefocus=True, text='Confirm')
-        self.button13.grid(column='0', row='1')
-        self.dialogRemote.rowconfigure('1', pad='30')
-        self.button13.configure(command=self.psuRemote)
-        self.button14 = ttk.Button(self.dialogRemote)
-        self.button14.configure(takefocus=True, text='Abort')
-        self.button14.grid(column='1', row='1')
-        self.dialogRemote.columnconfigure('1', pad='20')
-        self.button14.configure(command=self.psuRemoteDialogClose)
-        self.dialogRemote.configure(height='200', width='200')
-        self.dialogRemote.title('Switch to Remote?')
-        self.dialogRemote.withdraw()
     
-    def run(self):
-        self.updateListings(True)
-        self.mainwindow.mainloop()
-    
-    def updatePorts(self):
-        pList  = self.builder.get_object("portList")
-        ports = serial.tools.list_ports.comports()
-        pList["values"] = [port for port in ports]
-        
-        print("\nPrinting all available ports:")
-        for port in ports:
-            print(port.name, "-", port.description)
-        print()
-        return self
-    
-    def preselectPort(self):
-        if DEVICE_COM_NAME == "" or DEVICE_COM_NAME is None:
-            return self
-        pList  = self.builder.get_object("portList")
-        ports = serial.tools.list_ports.comports()
-        for port in ports:
-            print(port.name, "-", port.description)
-            if bool(re.match(DEVICE_COM_REGEX, port.description)):
-                pList.set(port)
-        return self
-    
-    def getSelectedPort(self):
-        pList  = self.builder.get_object("portList")
-        selected = pList.get()
-        ports = serial.tools.list_ports.comports()
-        self.selectedPort = None
-        for port in ports:
-            if selected == str(port):
-                if self.selectedPort is None:
-                    self.selectedPort = port
-                else:
-                    raise ValueError("Port Duplicate found - should not happen")
-        
-        for com in self.coms:
-            if com.serialConnection is not None:
-                com.close()
-        
-        
-        if self.selectedPort is not None:
-            try:
-                self.errorMsg.set("")
-                self.connectionStatus("   Working   ")
-                self.mainwindow.update()
-                self.com.open(self.selectedPort.name)
-                self.com.initialCom()
-                self.updateListings()
-                self.mainwindow.after(120000, self.updateCom, True)
-            except printableError as err:
-                self.errorMsg.set(err)
-            else:
-                self.errorMsg.set("")
-        return self
-    
-    def lock(self, oID):
-        lockButton = self.builder.get_object(oID)
-        portList   = self.builder.get_object("portList")
-        updateButton=self.builder.get_object("selectPortButton")
-        
-        if lockButton["text"] == "Unlock":
-            updateButton["state"] = "normal"
-            portList["state"]     = "readonly"
-            lockButton["text"]    = "Lock"
-        else:
-            updateButton["state"] = "disabled"
-            portList["state"]     = "disabled"
-            lockButton["text"]    = "Unlock"
+    def snapshot(self):
+        return {
+            "connected": self.is_connected(),
+            "channel": self.channel,
+            "status": self.status,
+            "isRemote": self.isRemote,
+            "frontpanel": self.frontpanel,
+            "voltageSet": self.voltageSet,
+            "currentSet": self.currentSet,
+            "voltageMeasured": self.voltageMeasured,
+            "currentMeasured": self.currentMeasured,
+            "voltageMax": self.voltageMax,
+            "currentMax": self.currentMax,
+            "voltageRequested": self.voltageRequested,
+            "currentRequested": self.currentRequested,
+        }
 
-    def setUserVoltage(self):
-        try:
-            self.com.voltageRequestedSet(self.userSetVoltage.get())
-            self.updateListings()
-            self.com.setVoltage() \
-                    .updateSetVoltage()
-            self.updateListings()
-        except tk.TclError:
-            self.errorMsg.set("Input for Voltage must be a floating point number or integer!")
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.errorMsg.set("")
+# The workers of several ports save state files at the same time
+stateFilesLock = threading.RLock()
 
-    def setUserCurrent(self):
-        try:
-            self.com.currentRequestedSet(self.userSetCurrent.get())
-            self.updateListings()
-            self.com.setCurrent() \
-                    .updateSetCurrent()
-            self.updateListings()
-        except tk.TclError:
-            self.errorMsg.set("Input for Current must be a floating point number or integer!")
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.errorMsg.set("")
+class PsuStateFile:
+    """A JSON file in STATE_DIRECTORY, replaced as a whole on save.
     
-    def remeasure(self):
+    Every save writes a temporary file of its own next to it and moves it in
+    place. update reads, changes and saves under stateFilesLock, so concurrent
+    updates of different keys all survive.
+    """
+    def __init__(self, name, directory=None):
+        self.path = pathlib.Path(STATE_DIRECTORY if directory is None else directory) / name
+    
+    def load(self):
+        import json
         try:
-            self.connectionStatus("   Working   ")
-            self.mainwindow.update()
-            self.com.fullUpdate()
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.errorMsg.set("")
-    
-    def updateStatusPowerDisplay(self, status=-1):
-        onIndicator = self.builder.get_object("buttonPSUOn")
-        offIndicator= self.builder.get_object("buttonPSUOff")
-        if   status == 0:
-            # PSU is in Remote
-            onIndicator["background"] = "#00ff00"
-            offIndicator["background"]= "#770000"
-            onIndicator["activebackground"] = "#00ff00"
-            offIndicator["activebackground"]= "#770000"
-            onIndicator["state"] = "disabled"
-            offIndicator["state"] = "active"
-        elif status == 1:
-            # PSU is in Local
-            onIndicator["background"] = "#00aa00"
-            offIndicator["background"]= "#ff0000"
-            onIndicator["activebackground"] = "#00aa00"
-            offIndicator["activebackground"]= "#ff0000"
-            onIndicator["state"] = "active"
-            offIndicator["state"] = "disabled"
-        else:
-            # Status is unknown
-            onIndicator["background"] = "#00aa00"
-            offIndicator["background"]= "#770000"
-            onIndicator["activebackground"] = "#00aa00"
-            offIndicator["activebackground"]= "#770000"
-            onIndicator["state"] = "disabled"
-            offIndicator["state"] = "disabled"
-    
-    def psuOn(self):
-        print("Turn PSU On")
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+    
+    def save(self, data):
+        import json
+        import tempfile
+        with stateFilesLock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(".tmp", self.path.stem + ".", self.path.parent)
+            try:
+                with os.fdopen(descriptor, "w") as file:
+                    json.dump(data, file, indent=1)
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+    
+    def update(self, key, value):
+        with stateFilesLock:
+            data = self.load()
+            data[key] = value
+            self.save(data)
+    
+    def updateCache(self, key, value):
+        # update for files that only save work next time, failing is not fatal
         try:
-            self.com.psuOn()
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.errorMsg.set("")
+            self.update(key, value)
+        except OSError as err:
+            print("Could not save {}: {}".format(self.path, err), file=sys.stderr)
 
-    def psuOff(self):
-        print("Turn PSU Off")
-        try:
-            self.com.psuOff()
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.errorMsg.set("")
-    
-    def updateStatusRemoteDisplay(self, status=-1):
-        onIndicator = self.builder.get_object("buttonRemote")
-        offIndicator= self.builder.get_object("buttonLocal")
-        if   status == 0:
-            # PSU is On
-            onIndicator["background"] = "#00aa00"
-            offIndicator["background"]= "#ffff00"
-            onIndicator["activebackground"] = "#00aa00"
-            offIndicator["activebackground"]= "#ffff00"
-            onIndicator["state"] = "active"
-            offIndicator["state"] = "disabled"
-        elif status == 1:
-            # PSU is Off
-            onIndicator["background"] = "#00ff00"
-            offIndicator["background"]= "#aaaa00"
-            onIndicator["activebackground"] = "#00ff00"
-            offIndicator["activebackground"]= "#aaaa00"
-            onIndicator["state"] = "disabled"
-            offIndicator["state"] = "active"
-        else:
-            # Status is unknown
-            onIndicator["background"] = "#00aa00"
-            offIndicator["background"]= "#aaaa00"
-            onIndicator["activebackground"] = "#00aa00"
-            offIndicator["activebackground"]= "#aaaa00"
-            onIndicator["state"] = "disabled"
-            offIndicator["state"] = "disabled"
-    
-    def psuLocalDialog(self):
+class PsuTopology:
+    """Which addresses of a bus have a supply, remembered per port.
+    
+    discover scans the bus once and saves the channels with their maximum
+    values and identification. Later it only probes the saved channels and
+    scans again if one of them is missing.
+    """
+    def __init__(self, file=None):
+        self.file = PsuStateFile("topology.json") if file is None else file
+    
+    def cached(self, port):
+        entry = self.file.load().get(str(port))
+        if not entry:
+            return None
+        return {int(channel): info for channel, info in entry["channels"].items()}
+    
+    def discover(self, bus, rescan=False, addresses=range(1, 30)):
+        cached = None if rescan else self.cached(bus.port)
+        if cached and self.scan(bus, cached) == sorted(cached):
+            return cached
+        return self.remember(bus.port, {channel: self.identify(bus, channel) for channel in self.scan(bus, addresses)})
+    
+    def remember(self, port, channels):
+        self.file.updateCache(str(port), {"channels": {str(channel): info for channel, info in channels.items()},
+                                          "scanned": time()})
+        return channels
+    
+    @staticmethod
+    def scan(bus, addresses):
+        # Right after the link was negotiated its scan is taken, once, where
+        # it covered the addresses
+        probed, bus.probed = bus.probed, None
+        if probed is not None and set(addresses) <= set(probed[0]):
+            return sorted(set(probed[1]).intersection(addresses))
+        return bus.scan(addresses)
+    
+    @staticmethod
+    def identify(bus, channel):
+        com = PsuControlCom(channel, bus)
+        com.setChannel(channel).updateMaxValues()
         try:
-            self.dialogLocal.deiconify()
-        except tk.TclError:
-            self.initDialogLocal(self.mainwindow)
-            self.dialogLocal.deiconify()
-        #self.initDialogLocal(self.mainwindow)
-    
-    def psuLocal(self):
-        print("Switch PSU to Local")
-        self.dialogLocal.withdraw()
+            com.updateIdentification()
+        except missingFrameError:
+            # Not every interface knows *IDN?
+            pass
+        return PsuTopology.identity(com)
+    
+    @staticmethod
+    def identity(com):
+        return {"voltageMax": com.voltageMax, "currentMax": com.currentMax, "identification": com.identification}
+
+class PsuLinkNegotiator:
+    """Finds the fastest baud rate a port answers at reliably.
+    
+    The rates are tried fastest first. At each the addresses are scanned with
+    CH n and CH? (see PsuBus.scan), and the supplies found are asked again
+    tries - 1 times. The first rate at which they answer every time is taken. Where the topology of the port
+    is known only its channels are scanned. The result is saved per
+    port in links.json together with the adapter (e.g. the hwid of the USB
+    serial adapter) if one is given, so later connections open at once at the
+    saved rate and only probe again when it fails or the adapter changed.
+    The supplies found are left in bus.probed for PsuTopology.discover.
+    """
+    def __init__(self, rates=BAUDRATES, tries=3, file=None):
+        self.rates = tuple(rates)
+        self.tries = tries
+        self.file = PsuStateFile("links.json") if file is None else file
+    
+    def cached(self, port, adapter=None):
+        entry = self.file.load().get(str(port))
+        if not entry or adapter is not None and entry.get("adapter") not in (None, adapter):
+            return None
+        return entry["baudrate"]
+    
+    def probe(self, bus, port, baudrate, addresses, tries):
+        bus.open(port, baudrate)
         try:
-            self.com.psuLocal()
-        except printableError as err:
-            self.errorMsg.set(err)
+            found = bus.scan(addresses)
+            stable = bool(found) and all(bus.scan(found) == found for _ in range(tries - 1))
+        except (printableError, serial.SerialException):
+            stable = False
+        if not stable:
+            bus.close()
         else:
-            self.errorMsg.set("")
+            # Saves PsuTopology.discover the scan
+            bus.probed = (tuple(addresses), found)
+        return stable
+    
+    def attempts(self, port, adapter=None, reprobe=False):
+        # (baudrate, tries, new) in the order they are probed. A saved rate
+        # comes first and only has to answer once.
+        cached = None if reprobe else self.cached(port, adapter)
+        if cached is not None:
+            yield cached, 1, False
+        for baudrate in self.rates:
+            if baudrate != cached:
+                yield baudrate, self.tries, True
+    
+    def negotiate(self, bus, port, adapter=None, reprobe=False):
+        # Leaves bus open at the rate found and returns it
+        addresses = PsuTopology().cached(port) or range(1, 30)
+        for baudrate, tries, new in self.attempts(port, adapter, reprobe):
+            if self.probe(bus, port, baudrate, addresses, tries):
+                return self.accept(port, baudrate, adapter) if new else baudrate
+        raise self.failed(port)
+    
+    def accept(self, port, baudrate, adapter=None):
+        self.file.updateCache(str(port), {"baudrate": baudrate, "adapter": adapter, "probed": time()})
+        return baudrate
+    
+    def failed(self, port):
+        return printableError("No supply answers on {} at {} baud".format(
+            port, ", ".join(str(rate) for rate in self.rates)))
 
-    def psuLocalDialogClose(self):
-        self.dialogLocal.withdraw()
+class PsuWarmState:
+    """The last known state of every channel, kept in state.json.
+    
+    Saved per port when a session ends, with the port and channel last shown.
+    The next session shows these values right away and PsuSession.initChannel
+    checks them with PsuControlCom.warmCom instead of running initialCom.
+    """
+    def __init__(self, file=None):
+        self.file = PsuStateFile("state.json") if file is None else file
+        self.data = self.file.load()
+    
+    def channel(self, port, channel):
+        return self.data.get("ports", {}).get(str(port), {}).get(str(channel))
+    
+    def snapshot(self, port, channel):
+        # A not connected snapshot with the saved values, for the state model
+        state = self.channel(port, channel)
+        snap = PsuStateModel.blank(channel)
+        if state is not None:
+            snap.update((key, state[key]) for key in snap if key in state)
+        return snap
+    
+    def last(self):
+        last = self.data.get("last")
+        return None if last is None else (last["port"], last["channel"])
+    
+    def save(self, ports, last=None):
+        # ports maps each port to its coms, only initialized channels are kept
+        with stateFilesLock:
+            data = self.file.load()
+            saved = data.setdefault("ports", {})
+            for port, coms in ports.items():
+                channels = {str(com.channel): com.warmState() for com in coms if com.status != -1 and com.voltageMax}
+                if channels:
+                    saved[str(port)] = channels
+            if last is not None:
+                data["last"] = {"port": last[0], "channel": last[1]}
+            data["saved"] = time()
+            self.file.save(data)
+        self.data = data
+        return self
 
-    def psuRemoteDialog(self):
-        try:
-            self.dialogRemote.deiconify()
-        except tk.TclError:
-            self.initDialogRemote(self.mainwindow)
-            self.dialogRemote.deiconify()
-    
-    def psuRemote(self):
-        print("Switch PSU to Remote")
-        self.dialogRemote.withdraw()
+class PsuPortRegistry(threading.Thread):
+    """The serial ports of this machine, enumerated once and then watched.
+    
+    Enumerating ports is slow where there are many virtual ones, so the
+    watcher thread only looks at a cheap signature every interval (the entries
+    of /sys/class/tty on Linux) and enumerates again when it changed. Where
+    there is no such signature it enumerates every interval. Changes are
+    queued as ("added" or "removed", ListPortInfo) events for pollEvents and
+    passed to the listeners on the watcher thread.
+    """
+    sysfs = pathlib.Path("/sys/class/tty")
+    
+    def __init__(self, interval=2.0):
+        super().__init__(name="PsuPortRegistry", daemon=True)
+        self.interval = interval
+        self.ports = {}
+        self.events = queue.Queue()
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.lastSignature = None
+        self.enumerations = 0
+        # Seeded without events, the ports present at start were not added
+        self.ports = self.enumerate()
+    
+    def signature(self):
         try:
-            self.com.psuRemote()
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.errorMsg.set("")
-
-    def psuRemoteDialogClose(self):
-        self.dialogRemote.withdraw()
-    
-    def updateFrontpanelLock(self, status=-1):
-        onIndicator = self.builder.get_object("fpLocked")
-        offIndicator= self.builder.get_object("fpUnlocked")
-        if   status == 0:
-            # PSU is On
-            onIndicator["background"] = "#00aaaa"
-            offIndicator["background"]= "#ffff00"
-            onIndicator["activebackground"] = "#00aaaa"
-            offIndicator["activebackground"]= "#ffff00"
-            onIndicator["state"] = "active"
-            offIndicator["state"] = "disabled"
-        elif status == 1:
-            # PSU is Off
-            onIndicator["background"] = "#00ffff"
-            offIndicator["background"]= "#aaaa00"
-            onIndicator["activebackground"] = "#00ffff"
-            offIndicator["activebackground"]= "#aaaa00"
-            onIndicator["state"] = "disabled"
-            offIndicator["state"] = "active"
+            return frozenset(os.listdir(self.sysfs))
+        except OSError:
+            return None
+    
+    def enumerate(self):
+        self.lastSignature = self.signature()
+        import serial.tools.list_ports
+        self.enumerations += 1
+        return {port.device: port for port in serial.tools.list_ports.comports()}
+    
+    def refresh(self, force=False):
+        if not force and self.lastSignature is not None and self.signature() == self.lastSignature:
+            return []
+        found = self.enumerate()
+        with self.lock:
+            old, self.ports = self.ports, found
+        events = ([("removed", port) for device, port in old.items() if device not in found]
+                  + [("added", port) for device, port in found.items() if device not in old])
+        for event in events:
+            self.events.put(event)
+            for listener in list(self.listeners):
+                listener(*event)
+        return events
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except OSError as err:
+                print("Port enumeration failed:", err)
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def list(self):
+        with self.lock:
+            return sorted(self.ports.values(), key=lambda port: port.device)
+    
+    def matching(self, regex=DEVICE_COM_REGEX):
+        return [port for port in self.list() if re.match(regex, port.description)]
+    
+    def find(self, text):
+        # By its listing, device path or name
+        for port in self.list():
+            if text in (str(port), port.device, port.name):
+                return port
+        return None
+    
+    def pollEvents(self):
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+class PsuPollScheduler:
+    """Cycles the measurement polls through the channels of one bus.
+    
+    Every channel earns credit by its weight each round, the channel with the
+    most credit is polled next. The channel on screen and channels with the
+    output on get more slots. Ties go to the channel the bus is addressed to,
+    and a channel keeps the bus for up to burst polls, so CH is sent as seldom
+    as possible. The estimated bytes of each poll are charged against a budget
+    of utilization times the bus capacity, which sets the pause between polls.
+    """
+    pollCommands = ("SOurce:FUnction:RSD?", "SOurce:FUnction:OUTP?", "MEasure:CUrrent?", "MEasure:VOltage?")
+    
+    def __init__(self, coms=(), utilization=0.5, maxRate=20.0, burst=4,
+                 focusWeight=8, activeWeight=4, idleWeight=1):
+        self.coms = list(coms)
+        self.utilization = utilization
+        self.maxRate = maxRate
+        self.burst = burst
+        self.focusWeight = focusWeight
+        self.activeWeight = activeWeight
+        self.idleWeight = idleWeight
+        self.focused = None
+        self.credit = {}
+        self.errors = {}
+        self.blockedUntil = {}
+        self.current = None
+        self.streak = 0
+        self.nextPoll = 0
+        self.polls = 0
+    
+    def add(self, com):
+        if com not in self.coms:
+            self.coms.append(com)
+        self.errors.pop(com, None)
+        self.blockedUntil.pop(com, None)
+        return self
+    
+    def remove(self, com):
+        if com in self.coms:
+            self.coms.remove(com)
+        self.credit.pop(com, None)
+        return self
+    
+    def focus(self, com):
+        self.focused = com
+        return self
+    
+    def weight(self, com):
+        if com is self.focused:
+            return self.focusWeight
+        if com.status == 0:
+            return self.activeWeight
+        return self.idleWeight
+    
+    def due(self):
+        # Seconds until the next poll may start, None without channels
+        if not self.coms:
+            return None
+        return max(self.nextPoll - monotonic(), 0)
+    
+    def pick(self):
+        now = monotonic()
+        ready = [com for com in self.coms if self.blockedUntil.get(com, 0) <= now]
+        if not ready:
+            return None
+        if self.current in ready and self.streak < self.burst:
+            return self.current
+        for com in ready:
+            self.credit[com] = self.credit.get(com, 0) + self.weight(com)
+        active = lambda com: com.channel == com.bus.activeChannel
+        com = max(ready, key=lambda com: (self.credit[com], active(com)))
+        self.credit[com] -= sum(self.weight(other) for other in ready)
+        return com
+    
+    def step(self):
+        com = self.pick()
+        if com is None:
+            self.nextPoll = monotonic() + 1.0
+            return None
+        if com is self.current:
+            self.streak += 1
         else:
-            # Status is unknown
-            onIndicator["background"] = "#00aaaa"
-            offIndicator["background"]= "#aaaa00"
-            onIndicator["activebackground"] = "#00aaaa"
-            offIndicator["activebackground"]= "#aaaa00"
-            onIndicator["state"] = "disabled"
-            offIndicator["state"] = "disabled"
-    
-    def frontpanelLock(self):
+            self.current, self.streak = com, 1
+        switch = com.channel != com.bus.activeChannel
+        # An output that was off is not measured, see updateMeasuredCurrent
+        measured = com.status != 1
+        batch = com.batch()
+        com.updateStatus(batch) \
+            .updateMeasuredCurrent(batch) \
+            .updateMeasuredVoltage(batch)
         try:
-            self.com.fpLock()
-        except printableError as err:
-            self.errorMsg.set(err)
+            batch.execute()
+        except (printableError, ValueError):
+            errors = self.errors[com] = self.errors.get(com, 0) + 1
+            self.blockedUntil[com] = monotonic() + min(2 ** errors, 60)
+            raise
         else:
-            self.errorMsg.set("")
+            self.errors.pop(com, None)
+        finally:
+            self.polls += 1
+            self.throttle(com, switch, measured)
+        return com
     
-    def frontpanelUnlock(self):
-        try:
-            self.com.fpUnlock()
-        except printableError as err:
-            self.errorMsg.set(err)
+    def throttle(self, com, switch, measured=True):
+        # Query lines plus about 10 bytes per answer, 10 bits per byte
+        commands = self.pollCommands if measured else self.pollCommands[:2]
+        size = sum(len(command) + 11 for command in commands)
+        if switch:
+            size += len("CH {}\n".format(com.channel))
+        baudrate = com.serialConnection.baudrate if com.serialConnection is not None else 9600
+        pause = max(size * 10 / (baudrate * self.utilization), 1 / self.maxRate)
+        self.nextPoll = monotonic() + pause
+
+class PsuSetpointQueue:
+    """Setpoints waiting to be written, only the newest per channel and quantity.
+    
+    A value that is replaced before it went out is dropped, so fast changes do
+    not queue up on a slow bus. flush writes everything pending, one batch per
+    channel, and reads the setpoints back if readBack.
+    """
+    def __init__(self, readBack=True):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.readBack = readBack
+        self.dropped = 0
+        self.sent = 0
+    
+    def put(self, com, quantity, value):
+        # Returns True if the queue was empty, then a flush has to be scheduled
+        if quantity == "voltage":
+            com.voltageRequestedSet(value)
+        elif quantity == "current":
+            com.currentRequestedSet(value)
         else:
-            self.errorMsg.set("")
-        
-    
-    def updateListings(self, loop=False):
-        com = self.com
-        bu = self.builder
-        self.updateStatusPowerDisplay(com.status)
-        self.updateStatusRemoteDisplay(com.isRemote)
-        self.updateFrontpanelLock(com.frontpanel)
-        self.connectionStatus()
-        bu.get_object("messageVSetz")["text"] = formatNum(com.voltageRequested, "V")
-        bu.get_object("messageASetz")["text"] = formatNum(com.currentRequested, "A")
-        bu.get_object("messageVPSU")["text"] = formatNum(com.voltageSet, "V")
-        bu.get_object("messageAPSU")["text"] = formatNum(com.currentSet, "A")
-        bu.get_object("messageVMea")["text"] = formatNum(com.voltageMeasured, "V")
-        bu.get_object("messageAMea")["text"] = formatNum(com.currentMeasured, "A")
-        self.mainwindow.update()
-        if loop:
-            self.mainwindow.after(1000, self.updateListings, True)
-    
-    def updateCom(self, loop=False):
-        self.connectionStatus("   Working   ")
-        self.mainwindow.update()
+            raise ValueError("quantity is voltage or current, not {!r}".format(quantity))
+        with self.lock:
+            empty = not self.pending
+            if (com, quantity) in self.pending:
+                self.dropped += 1
+            self.pending[(com, quantity)] = value
+        return empty
+    
+    def depth(self):
+        with self.lock:
+            return len(self.pending)
+    
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        coms = {}
+        for (com, quantity), value in pending.items():
+            coms.setdefault(com, {})[quantity] = value
+        error = None
+        for com, values in coms.items():
+            batch = com.batch()
+            if "voltage" in values:
+                com.voltageRequested = values["voltage"]
+                com.setVoltage(batch)
+            if "current" in values:
+                com.currentRequested = values["current"]
+                com.setCurrent(batch)
+            if self.readBack:
+                if "voltage" in values:
+                    com.updateSetVoltage(batch)
+                if "current" in values:
+                    com.updateSetCurrent(batch)
+            try:
+                batch.execute()
+            except (printableError, ValueError) as err:
+                error = err if error is None else error
+            else:
+                self.sent += len(values)
+        if error is not None:
+            raise error
+        return self
+
+class PsuControlWorker(threading.Thread):
+    """Owns all serial I/O of the given PsuControlCom objects.
+    
+    Jobs are callables put on a queue and run one after another on this thread.
+    Results (or the printableError raised) are handed back through a second
+    queue, which the GUI drains from its mainloop. After every job a snapshot of
+    each com is published, so readers never touch a com while it is busy. The
+    snapshots also go to state under port, if given. Setpoints bypass the queue
+    through setpoint and are coalesced in a PsuSetpointQueue.
+    """
+    def __init__(self, coms, scheduler=None, port=None, state=None, results=None):
+        super().__init__(name="PsuControlWorker" if port is None else "PsuControlWorker {}".format(port), daemon=True)
+        self.coms = coms
+        self.bus = coms[0].bus if coms else None
+        self.scheduler = scheduler
+        self.port = port
+        self.state = state
+        self.requests = queue.Queue()
+        self.results = queue.Queue() if results is None else results
+        self.setpoints = PsuSetpointQueue()
+        self.busy = False
+        self._snapshots = {}
+        self._snapshotLock = threading.Lock()
+        self.publish()
+    
+    def submit(self, func, *args, callback=None):
+        self.requests.put((func, args, callback))
+        return self
+    
+    def setpoint(self, com, quantity, value, callback=None):
+        # Only the first setpoint after a flush queues a job. Later ones replace
+        # the pending value until that job runs, jobs submitted after them
+        # still see them written.
+        if self.setpoints.put(com, quantity, value):
+            self.submit(self.setpoints.flush, callback=callback)
+        return self
+    
+    def stop(self):
+        self.requests.put((None, (), None))
+    
+    def run(self):
+        while True:
+            try:
+                func, args, callback = self.requests.get(timeout=self.pollDue())
+            except queue.Empty:
+                self.poll()
+                continue
+            if func is None:
+                break
+            self.busy = True
+            result, error = None, None
+            try:
+                result = func(*args)
+            except Exception as err:
+                # Whatever went wrong, the caller gets an answer
+                error = err
+            finally:
+                self.publish()
+                self.busy = not self.requests.empty()
+            self.results.put((callback, result, error))
+        for bus in {com.bus for com in self.coms} | ({self.bus} if self.bus is not None else set()):
+            bus.close()
+    
+    def pollDue(self):
+        # Without anything to poll the worker sleeps until the next job
+        if self.scheduler is None or not self.scheduler.coms:
+            return None
+        if not self.scheduler.coms[0].is_connected():
+            return None
+        return self.scheduler.due()
+    
+    def poll(self):
+        # Background polls only run while no job is waiting
+        if self.pollDue() is None:
+            return
+        error = None
         try:
-            if self.com.is_connected():
-                self.com.saveUpdate()
-                if loop:
-                    self.mainwindow.after(120000, self.updateCom, True)
-        except ValueError as err:
-            print("ValueError:", err)
-        else:
-            self.updateListings()
-        return self
-        
-    def openDocu(self):
-        os.startfile(DOCUMENTAION_PATH)
-    
-    def connectionStatus(self, alt=None):
-        msgBox = self.builder.get_object("message3")
-        if alt is not None:
-            msgBox["background"] = "#ffff00"
-            msgBox["foreground"] = "#000000"
-            msgBox["text"] = "{:<13}".format(alt)
-            return self
-        if self.com.is_connected():
-            msgBox["background"] = "#00ff00"
-            msgBox["foreground"] = "#000000"
-            msgBox["text"] = "  Connected  "
-        else:
-            msgBox["background"] = "#ff0000"
-            msgBox["foreground"] = "#ffffff"
-            msgBox["text"] = "Not connected"
+            self.scheduler.step()
+        except Exception as err:
+            # Goes to the results with no callback, see PsuControlApp.processResults
+            TRACE.log(TRACE_PRINT, "Polling failed: {}", err)
+            error = err
+        self.publish()
+        self.results.put((None, None, error))
+    
+    def publish(self):
+        snapshots = {com: com.snapshot() for com in self.coms}
+        with self._snapshotLock:
+            self._snapshots = snapshots
+        if self.state is not None:
+            self.state.update(self.port, snapshots.values())
+    
+    def snapshot(self, com):
+        with self._snapshotLock:
+            return self._snapshots[com]
+    
+    def pollResults(self):
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+class PsuStateModel:
+    """Latest snapshot of every channel on every port of a PsuSession.
+    
+    Written by the workers, read by the GUI and the command line. version
+    counts the updates, so readers can tell whether anything changed.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.version = 0
+    
+    @staticmethod
+    def blank(channel):
+        return {
+            "connected": False,
+            "channel": channel,
+            "status": -1,
+            "isRemote": -1,
+            "frontpanel": -1,
+            "voltageSet": None,
+            "currentSet": None,
+            "voltageMeasured": None,
+            "currentMeasured": None,
+            "voltageMax": 0,
+            "currentMax": 0,
+            "voltageRequested": None,
+            "currentRequested": None,
+        }
+    
+    def update(self, port, snapshots):
+        with self.lock:
+            for snap in snapshots:
+                self.snapshots[(port, snap["channel"])] = snap
+            self.version += 1
+    
+    def remove(self, port):
+        with self.lock:
+            for key in [key for key in self.snapshots if key[0] == port]:
+                del self.snapshots[key]
+            self.version += 1
+    
+    def get(self, port, channel):
+        with self.lock:
+            snap = self.snapshots.get((port, channel))
+        return self.blank(channel) if snap is None else snap
+    
+    def items(self):
+        with self.lock:
+            return sorted(self.snapshots.items(), key=lambda item: (str(item[0][0]), item[0][1]))
+
+class PsuSession:
+    """Several serial ports open at once, each with its own channels.
+    
+    Every port gets a PsuBus, a PsuPollScheduler and a PsuControlWorker, so
+    ports are polled in parallel. All workers publish into one PsuStateModel
+    and hand their results back through one queue. connect, disconnect and
+    initChannel are jobs for the worker of their port.
+    """
+    def __init__(self, channels=range(1, 16)):
+        self.channels = tuple(channels)
+        self.state = PsuStateModel()
+        self.results = queue.Queue()
+        self.workers = {}
+        self.warm = PsuWarmState()
+        self.warmStarts = 0
+    
+    def __contains__(self, port):
+        return port in self.workers
+    
+    def add(self, port, channels=None):
+        if port in self.workers:
+            return self.workers[port]
+        bus = PsuBus()
+        coms = [PsuControlCom(channel, bus) for channel in (self.channels if channels is None else channels)]
+        worker = self.workers[port] = PsuControlWorker(coms, PsuPollScheduler(), port, self.state, self.results)
+        worker.start()
+        return worker
+    
+    def remove(self, port):
+        worker = self.workers.pop(port, None)
+        if worker is not None:
+            # The worker closes the bus once it is done
+            worker.stop()
+            self.state.remove(port)
         return self
     
-    def confirmChannel(self):
-        self.connectionStatus("   Working   ")
-        self.mainwindow.update()
+    def stop(self, last=None):
+        # last is the (port, channel) to show first next time
         try:
-            port = self.selectedChannel.get()
-            self.com = self.coms[port-1]
-            if not self.com.is_connected():
-                self.getSelectedPort()
-            else:
-                self.updateCom()
-        except printableError as err:
-            self.errorMsg.set(err)
-        else:
-            self.selectedChannelTxt.set("Selected Channel: {}".format(port))
-            self.errorMsg.set("")
+            self.warm.save({port: worker.coms for port, worker in self.workers.items()}, last)
+        except OSError as err:
+            print("Could not save the channel state:", err)
+        for port in list(self.workers):
+            self.remove(port)
+    
+    def ports(self):
+        return list(self.workers)
+    
+    def buses(self):
+        return [worker.bus for worker in self.workers.values()]
+    
+    def com(self, port, channel):
+        worker = self.workers.get(port)
+        if worker is not None:
+            for com in worker.coms:
+                if com.channel == channel:
+                    return com
+        return None
+    
+    def snapshot(self, port, channel):
+        return self.state.get(port, channel)
+    
+    def busy(self, port=None):
+        if port is not None:
+            return port in self.workers and self.workers[port].busy
+        return any(worker.busy for worker in self.workers.values())
+    
+    def submit(self, port, func, *args, callback=None):
+        if port not in self.workers:
+            raise printableError("Connection is not jet established!\nPlease select a port.")
+        self.workers[port].submit(func, *args, callback=callback)
+        return self
+    
+    def setpoint(self, port, com, quantity, value, callback=None):
+        if port not in self.workers:
+            raise printableError("Connection is not jet established!\nPlease select a port.")
+        self.workers[port].setpoint(com, quantity, value, callback)
         return self
+    
+    def pollResults(self):
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+    
+    def gather(self, jobs):
+        # Runs (port, func, *args) jobs on the workers and blocks until all are
+        # done, returns (result, error) per job. Ports work in parallel.
+        answers = [None] * len(jobs)
+        pending = {}
+        for index, (port, func, *args) in enumerate(jobs):
+            def callback(result, error, index=index):
+                answers[index] = (result, error)
+            pending[callback] = port
+            self.submit(port, func, *args, callback=callback)
+        while pending:
+            try:
+                callback, result, error = self.results.get(timeout=0.5)
+            except queue.Empty:
+                # A worker that died answers nothing any more
+                for callback, port in list(pending.items()):
+                    if not self.workers[port].is_alive():
+                        del pending[callback]
+                        callback(None, printableError("The worker of {} stopped".format(port)))
+                continue
+            if callback is not None:
+                pending.pop(callback, None)
+                callback(result, error)
+        return answers
+    
+    def connect(self, port, baudrate=None, adapter=None, device=None):
+        # Job on the worker of port, see PsuBus.connect. device is where the
+        # adapter of port is opened if it is no longer under the name port.
+        self.disconnect(port)
+        return self.workers[port].bus.connect(port if device is None else device, baudrate, adapter)
+    
+    def disconnect(self, port):
+        # Job on the worker of port
+        worker = self.workers[port]
+        worker.bus.close()
+        for com in list(worker.scheduler.coms):
+            worker.scheduler.remove(com)
+    
+    def discover(self, port, rescan=False):
+        # Job on the worker of port: from now on it only has the channels found
+        worker = self.workers[port]
+        bus = worker.bus
+        channels = PsuTopology().discover(bus, rescan)
+        known = {com.channel: com for com in worker.coms}
+        worker.coms[:] = [known.get(channel) or PsuControlCom(channel, bus) for channel in sorted(channels)]
+        for com in list(worker.scheduler.coms):
+            if com not in worker.coms:
+                worker.scheduler.remove(com)
+        self.state.remove(port)
+        return channels
+    
+    def reconnect(self, port, channels=None, poll=True, device=None, adapter=None):
+        # Job on the worker of port once its adapter is back, with the baud
+        # rate of before, at device if it came back under another name (see
+        # adapterPort). By default the channels that were polled are polled
+        # again. Returns the channels that answered.
+        worker = self.workers[port]
+        focused = worker.scheduler.focused
+        if channels is None:
+            channels = [com.channel for com in worker.scheduler.coms]
+        self.connect(port, worker.bus.baudrate, adapter, device)
+        self.discover(port)
+        found = []
+        for channel in channels:
+            if self.com(port, channel) is not None:
+                self.initChannel(port, channel, poll, focused is not None and channel == focused.channel)
+                found.append(channel)
+        return found
+    
+    def adapterPort(self, adapter, links=None):
+        # The disconnected port of the session whose adapter (hwid) is saved
+        # in links.json as adapter, e.g. when ttyUSB0 came back as ttyUSB1
+        if not adapter:
+            return None
+        links = PsuLinkNegotiator().file.load() if links is None else links
+        for port, worker in self.workers.items():
+            entry = links.get(str(worker.bus.port)) or links.get(str(port)) or {}
+            if entry.get("adapter") == adapter and not worker.bus.is_connected():
+                return port
+        return None
+    
+    def initChannel(self, port, channel, poll=True, focus=True):
+        # Job on the worker of port
+        com = self.com(port, channel)
+        if com is None:
+            raise printableError("No supply answers on channel {} of {}".format(channel, port))
+        state = self.warm.channel(port, channel)
+        if state is None:
+            com.initialCom()
+        elif com.warmCom(state):
+            self.warmStarts += 1
+        scheduler = self.workers[port].scheduler
+        if poll:
+            scheduler.add(com)
+        if focus:
+            scheduler.focus(com)
+        return com
 
 def formatNum(number, unit):
     steps=[(1e6, "M", 1e-6), (1e3, "k", 1e-3), (1, " ", 1), (1e-3, "m", 1e3), (1e-6, "μ", 1e6)]
@@ -694,9 +2372,318 @@ def formatNum(number, unit):
         test,char,mult = steps[-1]
         return "{: >6.2f}{}{}".format(number * mult, char, unit)
 
-if __name__ == '__main__':
+def openChannels(args):
+    bus = PsuBus().connect(args.port, args.baudrate)
+    channels = args.channel or sorted(PsuTopology().discover(bus))
+    if not channels:
+        bus.close()
+        raise printableError("No supply answers on {}".format(args.port))
+    coms = [PsuControlCom(channel, bus) for channel in channels]
+    for com in coms:
+        com.initialCom()
+    return bus, coms
+
+def printChannel(com, asJson=False):
+    snap = com.snapshot()
+    if asJson:
+        import json
+        print(json.dumps(snap))
+        return
+    state = {0: "on", 1: "off"}.get(snap["status"], "unknown")
+    mode = {1: "remote"}.get(snap["isRemote"], "local")
+    print("CH {:>2}  {}  {:<7} set {} {}  measured {} {}  max {} {}".format(
+        snap["channel"], state.ljust(3), mode,
+        formatNum(snap["voltageSet"], "V"), formatNum(snap["currentSet"], "A"),
+        formatNum(snap["voltageMeasured"], "V"), formatNum(snap["currentMeasured"], "A"),
+        formatNum(snap["voltageMax"], "V"), formatNum(snap["currentMax"], "A")))
+
+def cliPorts(args):
+    for port in PsuPortRegistry().list():
+        marker = "*" if re.match(DEVICE_COM_REGEX, port.description) else " "
+        print("{} {:<14} {}".format(marker, port.device, port.description))
+    return 0
+
+def cliRead(args):
+    bus, coms = openChannels(args)
+    try:
+        for com in coms:
+            com.fullUpdate()
+            printChannel(com, args.json)
+    finally:
+        bus.close()
+    return 0
+
+def cliSet(args):
+    bus, coms = openChannels(args)
+    try:
+        for com in coms:
+            if args.remote:
+                com.psuRemote()
+            if args.voltage is not None:
+                com.voltageRequestedSet(args.voltage).setVoltage()
+            if args.current is not None:
+                com.currentRequestedSet(args.current).setCurrent()
+            if args.on:
+                com.psuOn()
+            if args.off:
+                com.psuOff()
+            if args.local:
+                com.psuLocal()
+            com.fullUpdate()
+            printChannel(com, args.json)
+    finally:
+        bus.close()
+    return 0
+
+def pollChannels(coms):
+    # Job on the worker of one port: one poll of each channel
+    errors = []
+    for com in coms:
+        batch = com.batch()
+        com.updateStatus(batch).updateMeasuredCurrent(batch).updateMeasuredVoltage(batch)
+        try:
+            batch.execute()
+        except (printableError, ValueError) as err:
+            errors.append((com, err))
+    return errors
+
+def cliScan(args):
+    bus = PsuBus().connect(args.port, args.baudrate)
+    try:
+        channels = PsuTopology().discover(bus, args.rescan)
+    finally:
+        bus.close()
+    if args.json:
+        import json
+        print(json.dumps({str(channel): info for channel, info in sorted(channels.items())}))
+        return 0
+    for channel, info in sorted(channels.items()):
+        print("CH {:>2}  max {} {}  {}".format(channel, formatNum(info["voltageMax"], "V"),
+                                               formatNum(info["currentMax"], "A"), info["identification"] or ""))
+    return 0 if channels else 1
+
+def cliPoll(args):
+    # Every port has its own worker, so the ports are polled in parallel
+    session = PsuSession(args.channel or range(1, 30))
+    output = sys.stdout if args.output is None else open(args.output, "a")
+    server = None
+    registry = None
+    lost = set()
+    coms = []
+    try:
+        for port in args.port:
+            session.add(port)
+        for result, error in session.gather([(port, session.connect, port, args.baudrate) for port in args.port]):
+            if error is not None:
+                raise error
+        if not args.channel:
+            # Only the channels that answer on each port
+            for result, error in session.gather([(port, session.discover, port) for port in args.port]):
+                if error is not None:
+                    raise error
+        coms = {port: list(session.workers[port].coms) for port in args.port}
+        for result, error in session.gather([(port, session.initChannel, port, com.channel, False, False)
+                                             for port in args.port for com in coms[port]]):
+            if error is not None:
+                raise error
+        limits = (args.max_voltage, args.max_current, args.max_power, args.max_voltage_rate, args.max_current_rate)
+        if any(limit is not None for limit in limits):
+            for port in args.port:
+                for com in coms[port]:
+                    com.setInterlock(PsuInterlock(*limits))
+        if args.metrics_port is not None:
+            server = PsuMetricsServer(session.buses, args.metrics_port)
+            server.start()
+        if args.log is not None:
+            for port in args.port:
+                directory = pathlib.Path(args.log)
+                if len(args.port) > 1:
+                    directory = directory / re.sub(r"[^\w.-]+", "_", port)
+                directory.mkdir(parents=True, exist_ok=True)
+                for com in coms[port]:
+                    com.logTo(directory)
+        if args.reconnect:
+            registry = PsuPortRegistry()
+            registry.start()
+        several = len(args.port) > 1
+        labels = {port: '"{}",'.format(port.replace('"', '""')) if "," in port or '"' in port else "{},".format(port)
+                  for port in args.port}
+        epoch = time() - monotonic()
+        start = monotonic()
+        count = 0
+        if output is sys.stdout or output.tell() == 0:
+            output.write("time,port,channel,voltage,current,status\n" if several else "time,channel,voltage,current,status\n")
+        while args.count is None or count < args.count:
+            if registry is not None:
+                back = {port.device for kind, port in registry.pollEvents() if kind == "added"}
+                for port in sorted(lost):
+                    # As soon as the adapter is back, now and then if it never left
+                    if port in back or count % 10 == 0 and registry.find(port) is not None:
+                        session.gather([(port, session.reconnect, port, [com.channel for com in coms[port]], False)])
+                for port in sorted(lost):
+                    if session.workers[port].bus.is_connected():
+                        coms[port] = [com for com in session.workers[port].coms if com in coms[port]]
+                        lost.discard(port)
+                        print("{}: reconnected".format(port), file=sys.stderr)
+            polled = [port for port in args.port if port not in lost]
+            answers = session.gather([(port, pollChannels, coms[port]) for port in polled])
+            for port, (errors, error) in zip(polled, answers):
+                failed = {com for com, err in errors or ()}
+                for com, err in errors or ():
+                    print("{} CH {}: {}".format(port, com.channel, err), file=sys.stderr)
+                if error is not None or not session.workers[port].bus.is_connected():
+                    if registry is None:
+                        return 1
+                    print("{}: connection lost, waiting for it to come back".format(port), file=sys.stderr)
+                    lost.add(port)
+                    continue
+                for com in coms[port]:
+                    if com in failed:
+                        continue
+                    sampleTime, voltage, current, status = com.samples.latest()
+                    output.write("{:.3f},{}{},{!r},{!r},{:d}\n".format(
+                        epoch + sampleTime, labels[port] if several else "", com.channel,
+                        voltage, current, int(status)))
+            output.flush()
+            count += 1
+            # Scheduled from the start, so slow polls do not add up
+            delay = start + count * args.interval - monotonic()
+            if delay > 0:
+                sleep(delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for port in coms:
+            for com in coms[port]:
+                com.stopLog()
+        if server is not None:
+            server.stop()
+        if registry is not None:
+            registry.stop()
+        if output is not sys.stdout:
+            output.close()
+        session.stop()
+    return 0
+
+def cliSequence(args):
+    import json
+    from PSU_Sequence import PsuProfile, PsuSequencer, formatReport
+    bus, coms = openChannels(args)
+    try:
+        programs = []
+        for com in coms:
+            if args.csv is not None:
+                profile = PsuProfile.fromCsv(args.csv, com.channel)
+            else:
+                start, stop, duration = args.ramp
+                profile = PsuProfile.ramp(start, stop, duration, args.interval, args.quantity)
+            programs.append((com, profile))
+        sequencer = PsuSequencer(programs, args.verify, args.tolerance)
+        sequencer.start()
+        try:
+            while sequencer.is_alive():
+                sequencer.join(0.2)
+        except KeyboardInterrupt:
+            sequencer.stop()
+            sequencer.join()
+        report = sequencer.report()
+        print(json.dumps(report) if args.json else formatReport(report))
+    finally:
+        bus.close()
+    return 1 if report["error"] is not None or report["mismatches"] else 0
+
+def cliGui(args):
+    import PSU_Gui
     print(f"This is PSU_Control Version {__version__}")
-    app = PsuControlApp()
+    app = PSU_Gui.PsuControlApp()
     app.preselectPort()
     app.updatePorts()
+    app.warmStart()
     app.run()
+    return 0
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Controls Delta Elektronika SM power supplies over RS232. "
+                                                 "Without a command the GUI is started.")
+    parser.add_argument("--trace", choices=("off", "record", "print"), help="bus tracing level")
+    parser.add_argument("--version", action="version", version=__version__)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("gui", help="start the GUI")
+    commands.add_parser("ports", help="list serial ports, * marks PSU interfaces")
+    scan = commands.add_parser("scan", help="find the supplies on a bus")
+    scan.add_argument("port", help="serial port, e.g. COM3, /dev/ttyUSB0 or psusim://?channels=1,2")
+    scan.add_argument("--baudrate", type=int, help="default is the fastest rate the port answers at")
+    scan.add_argument("--rescan", action="store_true", help="scan all addresses even if the port is known")
+    scan.add_argument("--json", action="store_true")
+    def channelParser(name, help, several=False):
+        sub = commands.add_parser(name, help=help)
+        if several:
+            sub.add_argument("port", nargs="+", help="serial ports, polled in parallel; "
+                                                     "with several ports the CSV gets a port column")
+        else:
+            sub.add_argument("port", help="serial port, e.g. COM3, /dev/ttyUSB0 or psusim://?channels=1,2")
+        sub.add_argument("-c", "--channel", type=int, action="append",
+                         help="channel address, may be given several times; "
+                              "default are the channels found on the bus")
+        sub.add_argument("--baudrate", type=int, help="default is the fastest rate the port answers at, "
+                                                      "found once and remembered per port")
+        return sub
+    read = channelParser("read", "read setpoints and measured values once")
+    read.add_argument("--json", action="store_true")
+    setter = channelParser("set", "change setpoints and output state")
+    setter.add_argument("--voltage", type=float)
+    setter.add_argument("--current", type=float)
+    state = setter.add_mutually_exclusive_group()
+    state.add_argument("--on", action="store_true")
+    state.add_argument("--off", action="store_true")
+    mode = setter.add_mutually_exclusive_group()
+    mode.add_argument("--remote", action="store_true")
+    mode.add_argument("--local", action="store_true")
+    setter.add_argument("--json", action="store_true")
+    poll = channelParser("poll", "poll measured values continuously as CSV", True)
+    poll.add_argument("--interval", type=float, default=1.0, help="s between polls of all channels")
+    poll.add_argument("--count", type=int, help="stop after this many polls")
+    poll.add_argument("--output", help="append the CSV to this file instead of stdout")
+    poll.add_argument("--log", help="also write binary logs to this directory")
+    poll.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    poll.add_argument("--reconnect", action="store_true",
+                      help="keep going when a port is lost and reconnect once its adapter is back")
+    poll.add_argument("--max-voltage", type=float, help="interlock: switch a channel off above this voltage")
+    poll.add_argument("--max-current", type=float, help="interlock: switch a channel off above this current")
+    poll.add_argument("--max-power", type=float, help="interlock: switch a channel off above this power in W")
+    poll.add_argument("--max-voltage-rate", type=float, help="interlock: switch off if the voltage changes faster, V/s")
+    poll.add_argument("--max-current-rate", type=float, help="interlock: switch off if the current changes faster, A/s")
+    sequence = channelParser("sequence", "play a setpoint profile with timed writes")
+    profile = sequence.add_mutually_exclusive_group(required=True)
+    profile.add_argument("--csv", help="CSV with time,voltage,current and optionally channel columns")
+    profile.add_argument("--ramp", type=float, nargs=3, metavar=("START", "STOP", "DURATION"))
+    sequence.add_argument("--quantity", choices=("voltage", "current"), default="voltage", help="what --ramp sets")
+    sequence.add_argument("--interval", type=float, default=0.1, help="s between the setpoints of --ramp")
+    sequence.add_argument("--verify", action="store_true", help="read every setpoint back")
+    sequence.add_argument("--tolerance", type=float, default=0.01, help="allowed read back difference")
+    sequence.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.trace is not None:
+        TRACE.level = {"off": TRACE_OFF, "record": TRACE_RECORD, "print": TRACE_PRINT}[args.trace]
+    handler = {
+        None: cliGui,
+        "gui": cliGui,
+        "ports": cliPorts,
+        "scan": cliScan,
+        "read": cliRead,
+        "set": cliSet,
+        "poll": cliPoll,
+        "sequence": cliSequence,
+    }[args.command]
+    try:
+        return handler(args)
+    except printableError as err:
+        print(err, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    # The GUI imports this module by name, it has to find this instance
+    sys.modules.setdefault("PSU_Control", sys.modules[__name__])
+    sys.exit(main())
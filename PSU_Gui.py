@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+"""PSU_Gui.py: The tkinter/pygubu front end of PSU_Control, only imported when the GUI is started."""
+
+__author__      = "Owen Dennis McGinnis"
+__email__       = "mcginnis@atom.uni-frankfurt.de"
+
+
+import os
+import tkinter as tk
+import tkinter.ttk as ttk
+import pygubu
+
+from PSU_Control import (PROJECT_PATH, PROJECT_UI, ICON_PATH, DOCUMENTAION_PATH, DEVICE_COM_NAME,
+                         DEVICE_COM_REGEX, METRICS_PORT, TRACE, TRACE_PRINT, printableError, PsuControlCom,
+                         PsuSession, PsuMetricsServer, PsuDecimator, PsuPortRegistry, formatNum)
+
+
+class PsuChannelView:
+    """The rendered state of one channel, only changed fields go to Tk.
+    
+    messages are (field, widget, unit) shown with formatNum, indicators are
+    (field, update) with update called on the new value. Each field remembers
+    the value it was last rendered from, so an unchanged value is neither
+    formatted nor configured again. render only looks at the fields in snap.
+    """
+    def __init__(self, messages=(), indicators=()):
+        self.messages = list(messages)
+        self.indicators = list(indicators)
+        self.rendered = {}
+        self.renders = 0
+    
+    def reset(self):
+        # Everything is drawn again on the next render
+        self.rendered.clear()
+    
+    def render(self, snap):
+        rendered = self.rendered
+        changed = False
+        for field, widget, unit in self.messages:
+            if field in snap and (field not in rendered or rendered[field] != snap[field]):
+                rendered[field] = snap[field]
+                widget["text"] = formatNum(snap[field], unit)
+                changed = True
+        for field, update in self.indicators:
+            if field in snap and (field not in rendered or rendered[field] != snap[field]):
+                rendered[field] = snap[field]
+                update(snap[field])
+                changed = True
+        self.renders += changed
+        return changed
+
+class PsuOverview:
+    """Window with a row per channel of the session: measured values, output
+    state and a plot of voltage and current over the whole run.
+    
+    The plots are min/max envelopes from PsuDecimator, so drawing them costs
+    the same after a minute or after hours. The window is redrawn every
+    refresh seconds, however fast the channels are polled.
+    """
+    plotWidth = 300
+    plotHeight = 40
+    
+    def __init__(self, session, master, refresh=1.0, closed=None):
+        self.session = session
+        self.closed = closed
+        self.window = tk.Toplevel(master)
+        self.window.title('Overview')
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        header = ttk.Frame(self.window)
+        header.pack(side='top', fill='x', padx='5', pady='5')
+        ttk.Label(header, text='Refresh [s]').pack(side='left')
+        self.refresh = tk.DoubleVar(self.window, refresh)
+        ttk.Spinbox(header, from_=0.2, to=60, increment=0.2, width=6, textvariable=self.refresh).pack(side='left')
+        self.body = ttk.Frame(self.window)
+        self.body.pack(side='top', fill='both', expand=True, padx='5', pady='5')
+        self.rows = {}
+        self.job = None
+        self.redraw()
+    
+    def close(self):
+        if self.job is not None:
+            self.window.after_cancel(self.job)
+        self.window.destroy()
+        if self.closed is not None:
+            self.closed()
+    
+    def interval(self):
+        try:
+            return max(self.refresh.get(), 0.2)
+        except tk.TclError:
+            return 1.0
+    
+    def redraw(self):
+        items = self.session.state.items()
+        keys = [key for key, snap in items]
+        if keys != list(self.rows) or any(self.rows[key]["com"] is not self.session.com(*key) for key in keys):
+            self.rebuild(keys)
+        for key, snap in items:
+            row = self.rows[key]
+            row["view"].render(snap)
+            self.plot(row, snap)
+        self.job = self.window.after(int(self.interval() * 1000), self.redraw)
+    
+    def rebuild(self, keys):
+        # Channels came or went, the rows of the others keep their history
+        rows = {}
+        for key in keys:
+            row = self.rows.pop(key, None)
+            com = self.session.com(*key)
+            if row is None or row["com"] is not com:
+                row = self.addRow(key, com)
+            rows[key] = row
+        for row in self.rows.values():
+            row["frame"].destroy()
+        self.rows = rows
+        for index, row in enumerate(rows.values()):
+            row["frame"].grid(column='0', row=index, sticky='ew', pady='2')
+    
+    def addRow(self, key, com):
+        port, channel = key
+        frame = ttk.Frame(self.body)
+        ttk.Label(frame, text='{} CH {}'.format(port, channel), width=14).grid(column='0', row='0', rowspan='2')
+        voltage = ttk.Label(frame, foreground='#0000aa', width=10)
+        voltage.grid(column='1', row='0')
+        current = ttk.Label(frame, foreground='#aa0000', width=10)
+        current.grid(column='1', row='1')
+        output = tk.Label(frame, width=4)
+        output.grid(column='2', row='0', rowspan='2', padx='5')
+        canvas = tk.Canvas(frame, width=self.plotWidth, height=self.plotHeight, background='#ffffff',
+                           highlightthickness=0)
+        canvas.grid(column='3', row='0', rowspan='2')
+        def showOutput(status):
+            output.configure(text={0: 'ON', 1: 'OFF'}.get(status, '---'),
+                             background={0: '#00ff00', 1: '#ff0000'}.get(status, '#aaaaaa'))
+        plots = []
+        if com is not None:
+            for field, color in (("voltage", '#0000aa'), ("current", '#aa0000')):
+                plots.append((PsuDecimator(com.samples, field, self.plotWidth // 2), field + "Max",
+                              canvas.create_line(0, 0, 0, 0, fill=color)))
+        view = PsuChannelView([("voltageMeasured", voltage, "V"), ("currentMeasured", current, "A")],
+                              [("status", showOutput)])
+        return {"frame": frame, "com": com, "canvas": canvas, "plots": plots, "view": view}
+    
+    def plot(self, row, snap):
+        for decimator, top, line in row["plots"]:
+            # Nothing new, nothing to draw
+            if not decimator.update():
+                continue
+            coords = decimator.polyline(self.plotWidth, self.plotHeight, snap[top] or max(decimator.maxs, default=0))
+            if len(coords) >= 4:
+                row["canvas"].coords(line, *coords)
+
+class PsuControlApp:
+    def __init__(self, master=None):
+        self.builder = builder = pygubu.Builder()
+        builder.add_resource_path(PROJECT_PATH)
+        builder.add_from_file(PROJECT_UI)
+        self.mainwindow = builder.get_object('mainwindow', master)
+        self.img_Icon = tk.PhotoImage(file=ICON_PATH)
+        self.mainwindow.iconphoto(True, self.img_Icon)
+        
+        self.userSetVoltage = None
+        self.userSetCurrent = None
+        self.errorMsg = None
+        self.selectedChannel = 0
+        self.selectedChannelTxt = None
+        builder.import_variables(
+            self, ["userSetVoltage", "userSetCurrent", "errorMsg", "selectedChannel", "selectedChannelTxt",]
+        )
+        
+        builder.connect_callbacks(self)
+        
+        self.dialogLocal  = None
+        self.initDialogLocal(self.mainwindow)
+        self.dialogRemote = None
+        self.initDialogRemote(self.mainwindow)
+        
+        self.selectedPort = 1
+        # Ports stay open when another one is selected, they keep polling
+        self.session = PsuSession(range(1,16))
+        self.port = None
+        self.com = PsuControlCom(1)  # Stands in until a port is open
+        # Enumerated once, then watched for adapters coming and going
+        self.registry = PsuPortRegistry()
+        self.registry.start()
+        self.metricsServer = None
+        if METRICS_PORT is not None:
+            self.metricsServer = PsuMetricsServer(self.session.buses, METRICS_PORT)
+            self.metricsServer.start()
+        
+        bu = self.builder
+        self.view = PsuChannelView(
+            [(field, bu.get_object(name), unit) for name, field, unit in (
+                ("messageVSetz", "voltageRequested", "V"), ("messageASetz", "currentRequested", "A"),
+                ("messageVPSU", "voltageSet", "V"), ("messageAPSU", "currentSet", "A"),
+                ("messageVMea", "voltageMeasured", "V"), ("messageAMea", "currentMeasured", "A"))],
+            [("status", self.updateStatusPowerDisplay), ("isRemote", self.updateStatusRemoteDisplay),
+             ("frontpanel", self.updateFrontpanelLock), ("connection", self.showConnection)])
+        self.listedVersion = None
+        self.overview = None
+    
+    def initDialogLocal(self, master):
+        # build ui
+        self.dialogLocal = tk.Tk() if master is None else tk.Toplevel(master)
+        self.message9 = tk.Message(self.dialogLocal)
+        self.message9.configure(font='TkDefaultFont', text='Are you shure you want to switch to the local settings?\n\nWARNING: The power supply will return to the potentiometers settings on the front panel!', width='350')
+        self.message9.grid(column='0', columnspan='2', padx='10', pady='10', row='0')
+        self.dialogLocal.columnconfigure('0', pad='20')
+        self.buttonLocalConfirm = ttk.Button(self.dialogLocal)
+        self.buttonLocalConfirm.configure(takefocus=True, text='Confirm')
+        self.buttonLocalConfirm.grid(column='0', row='1')
+        self.dialogLocal.rowconfigure('1', pad='30')
+        self.buttonLocalConfirm.configure(command=self.psuLocal)
+        self.button12 = ttk.Button(self.dialogLocal)
+        self.button12.configure(takefocus=True, text='Abort')
+        self.button12.grid(column='1', row='1')
+        self.dialogLocal.columnconfigure('1', pad='20')
+        self.button12.configure(command=self.psuLocalDialogClose)
+        self.dialogLocal.configure(height='200', width='200')
+        self.dialogLocal.title('Switch to Local?')
+        self.dialogLocal.withdraw()
+    
+    def initDialogRemote(self, master):
+        # build ui
+        self.dialogRemote = tk.Tk() if master is None else tk.Toplevel(master)
+        self.message10 = tk.Message(self.dialogRemote)
+        self.message10.configure(font='TkDefaultFont', justify='left', text='Are you shure you want to switch to the remote settings?\n\nWARNING: The power supply will return to the set Voltage and Current!', width='350')
+        self.message10.grid(column='0', columnspan='2', ipadx='10', ipady='10', row='0')
+        self.dialogRemote.columnconfigure('0', pad='20')
+        self.button13 = ttk.Button(self.dialogRemote)
+        self.button13.configure(takefocus=True, text='Confirm')
+        self.button13.grid(column='0', row='1')
+        self.dialogRemote.rowconfigure('1', pad='30')
+        self.button13.configure(command=self.psuRemote)
+        self.button14 = ttk.Button(self.dialogRemote)
+        self.button14.configure(takefocus=True, text='Abort')
+        self.button14.grid(column='1', row='1')
+        self.dialogRemote.columnconfigure('1', pad='20')
+        self.button14.configure(command=self.psuRemoteDialogClose)
+        self.dialogRemote.configure(height='200', width='200')
+        self.dialogRemote.title('Switch to Remote?')
+        self.dialogRemote.withdraw()
+    
+    def run(self):
+        self.updateListings()
+        self.processResults(True)
+        self.mainwindow.mainloop()
+        self.registry.stop()
+        self.session.stop(None if self.port is None else (self.port, self.com.channel))
+    
+    def submit(self, func, *args, done=None):
+        # Runs func on the worker thread. Errors end up in the error message,
+        # done is called on the Tk thread once func succeeded.
+        if self.port not in self.session:
+            self.errorMsg.set("Connection is not jet established!\nPlease select a port.")
+            return self
+        self.connectionStatus("   Working   ")
+        self.session.submit(self.port, func, *args, callback=self.callback(done))
+        return self
+    
+    def submitSetpoint(self, quantity, value):
+        # Coalesced on the worker, dragging through values only sends the last
+        if self.port not in self.session:
+            self.errorMsg.set("Connection is not jet established!\nPlease select a port.")
+            return self
+        try:
+            self.session.setpoint(self.port, self.com, quantity, value, callback=self.callback())
+        except printableError as err:
+            self.errorMsg.set(err)
+        else:
+            self.connectionStatus("   Working   ")
+        return self
+    
+    def callback(self, done=None):
+        def callback(result, error):
+            if error is not None:
+                if isinstance(error, printableError):
+                    self.errorMsg.set(error)
+                else:
+                    print("{}:".format(type(error).__name__), error)
+                return
+            self.errorMsg.set("")
+            if done is not None:
+                done(result)
+        return callback
+    
+    def processResults(self, loop=False):
+        handled = False
+        for callback, result, error in self.session.pollResults():
+            handled = True
+            if callback is not None:
+                callback(result, error)
+            elif error is not None:
+                # Background polls have no callback
+                self.errorMsg.set("Polling failed: {}".format(error))
+        self.processPortEvents()
+        # Redrawn when something happened, not on a timer
+        if handled or self.session.state.version != self.listedVersion:
+            self.updateListings()
+        if loop:
+            self.mainwindow.after(50, self.processResults, True)
+    
+    def warmStart(self):
+        # The channel shown last is listed from state.json right away, the
+        # connection and the check against the device run in the background
+        last = self.session.warm.last()
+        if last is None:
+            return self
+        port, channel = last
+        found = self.registry.find(port)
+        if found is None:
+            return self
+        self.builder.get_object("portList").set(found)
+        self.selectedChannel.set(channel)
+        self.selectedChannelTxt.set("Selected Channel: {}".format(channel))
+        self.com = PsuControlCom(channel)
+        self.port = port
+        self.session.state.update(port, [self.session.warm.snapshot(port, channel)])
+        self.updateListings()
+        return self.getSelectedPort()
+    
+    def processPortEvents(self):
+        changed = False
+        for kind, port in self.registry.pollEvents():
+            changed = True
+            known = port.name if port.name in self.session else port.device if port.device in self.session else None
+            device = None
+            if known is None and kind != "removed":
+                # The adapter may come back under another name
+                known = self.session.adapterPort(port.hwid)
+                device = port.device
+            if known is None:
+                continue
+            if kind == "removed":
+                def done(result, device=port.device):
+                    self.errorMsg.set("{} was removed".format(device))
+                self.session.submit(known, self.session.workers[known].bus.close, callback=self.callback(done))
+            else:
+                # Adapter is back, pick up where it was
+                def done(channels, known=known, device=device):
+                    self.errorMsg.set("Reconnected {}".format(known if device is None else device))
+                    if device is not None and known == self.port:
+                        self.builder.get_object("portList").set(self.registry.find(device) or device)
+                self.session.submit(known, self.session.reconnect, known, None, True, device, port.hwid,
+                                    callback=self.callback(done))
+        if changed:
+            self.updatePorts()
+        return self
+    
+    def updatePorts(self):
+        pList  = self.builder.get_object("portList")
+        ports = self.registry.list()
+        pList["values"] = [port for port in ports]
+        
+        if TRACE.level >= TRACE_PRINT:
+            TRACE.log(TRACE_PRINT, "\nPrinting all available ports:")
+            for port in ports:
+                TRACE.log(TRACE_PRINT, "{} - {}", port.name, port.description)
+        return self
+    
+    def preselectPort(self):
+        if DEVICE_COM_NAME == "" or DEVICE_COM_NAME is None:
+            return self
+        pList  = self.builder.get_object("portList")
+        for port in self.registry.matching(DEVICE_COM_REGEX):
+            TRACE.log(TRACE_PRINT, "{} - {}", port.name, port.description)
+            pList.set(port)
+        return self
+    
+    def getSelectedPort(self):
+        pList  = self.builder.get_object("portList")
+        selected = pList.get()
+        self.selectedPort = self.registry.find(selected) if selected else None
+        
+        if self.selectedPort is not None:
+            self.errorMsg.set("")
+            self.port = self.selectedPort.name
+            device = None
+            for known in self.session.ports():
+                # An adapter that came back under another name keeps its worker
+                if known != self.port and self.session.workers[known].bus.port == self.selectedPort.device:
+                    self.port, device = known, self.selectedPort.device
+            self.session.add(self.port)
+            # The channel only exists on the port once it answered, until then
+            # a stand-in is kept. connect raises if it does not answer.
+            self.com = self.session.com(self.port, self.com.channel) or PsuControlCom(self.com.channel)
+            def done(com):
+                self.com = com
+                self.mainwindow.after(120000, self.updateCom, True)
+            self.submit(self.connect, self.port, self.com.channel, self.selectedPort.hwid, device, done=done)
+        elif self.port in self.session:
+            self.session.submit(self.port, self.session.disconnect, self.port)
+        return self
+    
+    def connect(self, port, channel, adapter=None, device=None):
+        # Runs on the worker thread of port. Afterwards only the channels that
+        # answered exist on the port. The baud rate is negotiated once per
+        # port and adapter. The other channels are polled as well, for the
+        # overview, and are set up by jobs of their own after this one.
+        self.session.connect(port, adapter=adapter, device=device)
+        channels = self.session.discover(port)
+        com = self.session.initChannel(port, channel)
+        for other in sorted(channels):
+            if other != channel:
+                self.session.submit(port, self.session.initChannel, port, other, True, False,
+                                    callback=self.callback())
+        return com
+    
+    def snapshot(self):
+        return self.session.snapshot(self.port, self.com.channel)
+    
+    def lock(self, oID):
+        lockButton = self.builder.get_object(oID)
+        portList   = self.builder.get_object("portList")
+        updateButton=self.builder.get_object("selectPortButton")
+        
+        if lockButton["text"] == "Unlock":
+            updateButton["state"] = "normal"
+            portList["state"]     = "readonly"
+            lockButton["text"]    = "Lock"
+        else:
+            updateButton["state"] = "disabled"
+            portList["state"]     = "disabled"
+            lockButton["text"]    = "Unlock"
+
+    def setUserVoltage(self):
+        try:
+            val = self.userSetVoltage.get()
+        except tk.TclError:
+            self.errorMsg.set("Input for Voltage must be a floating point number or integer!")
+            return
+        self.submitSetpoint("voltage", val)
+
+    def setUserCurrent(self):
+        try:
+            val = self.userSetCurrent.get()
+        except tk.TclError:
+            self.errorMsg.set("Input for Current must be a floating point number or integer!")
+            return
+        self.submitSetpoint("current", val)
+    
+    def remeasure(self):
+        self.submit(self.com.fullUpdate)
+    
+    def updateStatusPowerDisplay(self, status=-1):
+        onIndicator = self.builder.get_object("buttonPSUOn")
+        offIndicator= self.builder.get_object("buttonPSUOff")
+        if   status == 0:
+            # PSU is in Remote
+            onIndicator["background"] = "#00ff00"
+            offIndicator["background"]= "#770000"
+            onIndicator["activebackground"] = "#00ff00"
+            offIndicator["activebackground"]= "#770000"
+            onIndicator["state"] = "disabled"
+            offIndicator["state"] = "active"
+        elif status == 1:
+            # PSU is in Local
+            onIndicator["background"] = "#00aa00"
+            offIndicator["background"]= "#ff0000"
+            onIndicator["activebackground"] = "#00aa00"
+            offIndicator["activebackground"]= "#ff0000"
+            onIndicator["state"] = "active"
+            offIndicator["state"] = "disabled"
+        else:
+            # Status is unknown
+            onIndicator["background"] = "#00aa00"
+            offIndicator["background"]= "#770000"
+            onIndicator["activebackground"] = "#00aa00"
+            offIndicator["activebackground"]= "#770000"
+            onIndicator["state"] = "disabled"
+            offIndicator["state"] = "disabled"
+    
+    def psuOn(self):
+        print("Turn PSU On")
+        self.submit(self.com.psuOn)
+
+    def psuOff(self):
+        print("Turn PSU Off")
+        self.submit(self.com.psuOff)
+    
+    def updateStatusRemoteDisplay(self, status=-1):
+        onIndicator = self.builder.get_object("buttonRemote")
+        offIndicator= self.builder.get_object("buttonLocal")
+        if   status == 0:
+            # PSU is On
+            onIndicator["background"] = "#00aa00"
+            offIndicator["background"]= "#ffff00"
+            onIndicator["activebackground"] = "#00aa00"
+            offIndicator["activebackground"]= "#ffff00"
+            onIndicator["state"] = "active"
+            offIndicator["state"] = "disabled"
+        elif status == 1:
+            # PSU is Off
+            onIndicator["background"] = "#00ff00"
+            offIndicator["background"]= "#aaaa00"
+            onIndicator["activebackground"] = "#00ff00"
+            offIndicator["activebackground"]= "#aaaa00"
+            onIndicator["state"] = "disabled"
+            offIndicator["state"] = "active"
+        else:
+            # Status is unknown
+            onIndicator["background"] = "#00aa00"
+            offIndicator["background"]= "#aaaa00"
+            onIndicator["activebackground"] = "#00aa00"
+            offIndicator["activebackground"]= "#aaaa00"
+            onIndicator["state"] = "disabled"
+            offIndicator["state"] = "disabled"
+    
+    def psuLocalDialog(self):
+        try:
+            self.dialogLocal.deiconify()
+        except tk.TclError:
+            self.initDialogLocal(self.mainwindow)
+            self.dialogLocal.deiconify()
+        #self.initDialogLocal(self.mainwindow)
+    
+    def psuLocal(self):
+        print("Switch PSU to Local")
+        self.dialogLocal.withdraw()
+        self.submit(self.com.psuLocal)
+
+    def psuLocalDialogClose(self):
+        self.dialogLocal.withdraw()
+
+    def psuRemoteDialog(self):
+        try:
+            self.dialogRemote.deiconify()
+        except tk.TclError:
+            self.initDialogRemote(self.mainwindow)
+            self.dialogRemote.deiconify()
+    
+    def psuRemote(self):
+        print("Switch PSU to Remote")
+        self.dialogRemote.withdraw()
+        self.submit(self.com.psuRemote)
+
+    def psuRemoteDialogClose(self):
+        self.dialogRemote.withdraw()
+    
+    def updateFrontpanelLock(self, status=-1):
+        onIndicator = self.builder.get_object("fpLocked")
+        offIndicator= self.builder.get_object("fpUnlocked")
+        if   status == 0:
+            # PSU is On
+            onIndicator["background"] = "#00aaaa"
+            offIndicator["background"]= "#ffff00"
+            onIndicator["activebackground"] = "#00aaaa"
+            offIndicator["activebackground"]= "#ffff00"
+            onIndicator["state"] = "active"
+            offIndicator["state"] = "disabled"
+        elif status == 1:
+            # PSU is Off
+            onIndicator["background"] = "#00ffff"
+            offIndicator["background"]= "#aaaa00"
+            onIndicator["activebackground"] = "#00ffff"
+            offIndicator["activebackground"]= "#aaaa00"
+            onIndicator["state"] = "disabled"
+            offIndicator["state"] = "active"
+        else:
+            # Status is unknown
+            onIndicator["background"] = "#00aaaa"
+            offIndicator["background"]= "#aaaa00"
+            onIndicator["activebackground"] = "#00aaaa"
+            offIndicator["activebackground"]= "#aaaa00"
+            onIndicator["state"] = "disabled"
+            offIndicator["state"] = "disabled"
+    
+    def frontpanelLock(self):
+        self.submit(self.com.fpLock)
+    
+    def frontpanelUnlock(self):
+        self.submit(self.com.fpUnlock)
+        
+    
+    def updateListings(self):
+        self.listedVersion = self.session.state.version
+        snap = self.snapshot()
+        busy = self.session.busy(self.port)
+        self.view.render(dict(snap, connection="   Working   " if busy else snap["connected"]))
+    
+    def updateCom(self, loop=False):
+        com = self.com
+        def update():
+            if com.is_connected():
+                com.saveUpdate()
+                return True
+            return False
+        def done(connected):
+            if loop and connected:
+                self.mainwindow.after(120000, self.updateCom, True)
+        self.submit(update, done=done)
+        return self
+        
+    def openDocu(self):
+        os.startfile(DOCUMENTAION_PATH)
+    
+    def openOverview(self):
+        if self.overview is not None:
+            self.overview.window.lift()
+            return self
+        def closed():
+            self.overview = None
+        self.overview = PsuOverview(self.session, self.mainwindow, closed=closed)
+        return self
+    
+    def connectionStatus(self, alt=None):
+        if alt is None and self.session.busy(self.port):
+            alt = "   Working   "
+        self.view.render({"connection": self.snapshot()["connected"] if alt is None else alt})
+        return self
+    
+    def showConnection(self, state):
+        # state is True, False or a text shown while busy
+        msgBox = self.builder.get_object("message3")
+        if not isinstance(state, bool):
+            msgBox["background"] = "#ffff00"
+            msgBox["foreground"] = "#000000"
+            msgBox["text"] = "{:<13}".format(state)
+            return self
+        if state:
+            msgBox["background"] = "#00ff00"
+            msgBox["foreground"] = "#000000"
+            msgBox["text"] = "  Connected  "
+        else:
+            msgBox["background"] = "#ff0000"
+            msgBox["foreground"] = "#ffffff"
+            msgBox["text"] = "Not connected"
+        return self
+    
+    def confirmChannel(self):
+        try:
+            port = self.selectedChannel.get()
+            com = self.session.com(self.port, port)
+            if com is None and self.port in self.session and self.session.workers[self.port].bus.is_connected():
+                raise printableError("No supply answers on channel {}".format(port))
+            self.com = PsuControlCom(port) if com is None else com
+            if not self.snapshot()["connected"]:
+                self.getSelectedPort()
+            elif self.snapshot()["status"] == -1:
+                # Same bus, the channel was just never talked to
+                self.submit(self.session.initChannel, self.port, port)
+            else:
+                self.submit(self.session.workers[self.port].scheduler.focus, self.com)
+                self.updateCom()
+        except printableError as err:
+            self.errorMsg.set(err)
+        else:
+            self.selectedChannelTxt.set("Selected Channel: {}".format(port))
+            self.errorMsg.set("")
+            self.updateListings()
+        return self
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""PSU_Sequence.py: Plays timed voltage/current profiles (ramps, steps, CSV waveforms) on PsuControlCom channels."""
+
+__author__      = "Owen Dennis McGinnis"
+__email__       = "mcginnis@atom.uni-frankfurt.de"
+
+
+import csv
+import threading
+from time import monotonic
+
+from PSU_Control import printableError
+
+
+class PsuProfile:
+    """Setpoints of one channel over time.
+
+    points are (offset in s, voltage, current), a None value leaves that
+    setpoint as it is.
+    """
+    def __init__(self, points=()):
+        self.points = sorted(points, key=lambda point: point[0])
+
+    @property
+    def duration(self):
+        return self.points[-1][0] if self.points else 0
+
+    @classmethod
+    def ramp(cls, start, stop, duration, interval=0.1, quantity="voltage", at=0):
+        # One setpoint every interval, the last one is exactly stop
+        count = max(int(round(duration / interval)), 1)
+        values = [round(start + (stop - start) * i / count, 6) for i in range(count + 1)]
+        return cls.steps(values, duration / count, quantity, at)
+
+    @classmethod
+    def steps(cls, values, dwell, quantity="voltage", at=0):
+        if quantity not in ("voltage", "current"):
+            raise ValueError("quantity is voltage or current, not {!r}".format(quantity))
+        voltage = quantity == "voltage"
+        return cls((at + i * dwell, value if voltage else None, None if voltage else value)
+                   for i, value in enumerate(values))
+
+    @classmethod
+    def fromCsv(cls, path, channel=None):
+        # Columns time, voltage and current, empty cells keep the setpoint. With
+        # a channel column only the rows of channel are used.
+        points = []
+        with open(path, newline="") as file:
+            for row in csv.DictReader(file):
+                if channel is not None and row.get("channel") not in (None, "") and int(row["channel"]) != channel:
+                    continue
+                value = lambda name: float(row[name]) if row.get(name) not in (None, "") else None
+                points.append((float(row["time"]), value("voltage"), value("current")))
+        return cls(points)
+
+    def shifted(self, offset):
+        return PsuProfile((time + offset, voltage, current) for time, voltage, current in self.points)
+
+    def __add__(self, other):
+        # other starts where this profile ends
+        return PsuProfile(self.points + other.shifted(self.duration).points)
+
+class PsuSequencer(threading.Thread):
+    """Plays PsuProfiles on channels in the background.
+
+    Every setpoint is due at start plus its offset on the monotonic clock, so
+    late writes do not push back the ones after them. Setpoints that fell due
+    together go out back-to-back under the bus lock, one batch per channel so
+    each sends its own CH, and one that is already overtaken by
+    a newer setpoint of the same channel, or that repeats the value last sent,
+    is not sent at all. Read-backs only happen with verify. Writes hold the bus
+    lock like every transaction, so background polls delay them; report() tells
+    by how much.
+    """
+    def __init__(self, programs, verify=False, tolerance=0.01, lead=0.05, spin=0.002, done=None):
+        super().__init__(name="PsuSequencer", daemon=True)
+        self.programs = [(com, profile) for com, profile in programs]
+        self.verify = verify
+        self.tolerance = tolerance
+        self.lead = lead
+        self.spin = spin
+        self.done = done
+        self.stopped = threading.Event()
+        self.startTime = None
+        self.timings = []
+        self.writes = 0
+        self.skipped = 0
+        self.mismatches = []
+        self.error = None
+
+    def events(self):
+        events = []
+        for order, (com, profile) in enumerate(self.programs):
+            for time, voltage, current in profile.points:
+                for quantity, value in (("voltage", voltage), ("current", current)):
+                    if value is not None:
+                        events.append((time, order, com, quantity, value))
+        events.sort(key=lambda event: (event[0], event[1]))
+        return events
+
+    def check(self, events):
+        for time, order, com, quantity, value in events:
+            limit = com.voltageMax if quantity == "voltage" else com.currentMax
+            if not 0 <= value <= limit:
+                raise printableError("CH {}: {} {} at {} s is not in range 0 to {}".format(
+                    com.channel, quantity.capitalize(), value, time, limit))
+
+    def run(self):
+        try:
+            self.play()
+        except (printableError, ValueError) as err:
+            self.error = err
+        if self.done is not None:
+            self.done(self)
+
+    def stop(self):
+        self.stopped.set()
+
+    def play(self):
+        events = self.events()
+        self.check(events)
+        sent = {}
+        start = self.startTime = monotonic() + self.lead
+        index = 0
+        while index < len(events):
+            if not self.waitUntil(start + events[index][0]):
+                break
+            # Everything due by now, only the newest setpoint per channel counts
+            due = {}
+            now = monotonic() - start
+            while index < len(events) and events[index][0] <= now:
+                time, order, com, quantity, value = events[index]
+                if (com, quantity) in due:
+                    self.skipped += 1
+                due[(com, quantity)] = (time, value)
+                index += 1
+            changes = []
+            for (com, quantity), (time, value) in due.items():
+                if sent.get((com, quantity)) == value:
+                    self.skipped += 1
+                else:
+                    changes.append((com, quantity, time, value))
+            if changes:
+                self.send(changes, start)
+                for com, quantity, time, value in changes:
+                    sent[(com, quantity)] = value
+        self.stopped.set()
+        return self
+
+    def waitUntil(self, deadline):
+        # The last spin seconds are waited for busily, sleeping is not that exact
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return not self.stopped.is_set()
+            if remaining > self.spin:
+                if self.stopped.wait(remaining - self.spin):
+                    return False
+            elif self.stopped.is_set():
+                return False
+
+    def send(self, changes, start):
+        buses = {}
+        for change in changes:
+            buses.setdefault(change[0].bus, []).append(change)
+        for bus, group in buses.items():
+            coms = {}
+            for com, quantity, time, value in group:
+                coms.setdefault(com, []).append((quantity, time, value))
+            with bus.lock:
+                for com, changes in coms.items():
+                    batch = com.batch()
+                    for quantity, time, value in changes:
+                        if quantity == "voltage":
+                            com.voltageRequested = value
+                            com.setVoltage(batch)
+                        else:
+                            com.currentRequested = value
+                            com.setCurrent(batch)
+                    if self.verify:
+                        for quantity, time, value in changes:
+                            if quantity == "voltage":
+                                com.updateSetVoltage(batch)
+                            else:
+                                com.updateSetCurrent(batch)
+                    batch.execute()
+                    # A batch of one channel is a single write
+                    sentAt = bus.writeTime - start
+                    self.writes += 1
+                    for quantity, time, value in changes:
+                        self.timings.append((com.channel, quantity, time, sentAt))
+                        if self.verify:
+                            actual = com.voltageSet if quantity == "voltage" else com.currentSet
+                            if actual is None or abs(actual - value) > self.tolerance:
+                                self.mismatches.append((com.channel, quantity, time, value, actual))
+
+    def report(self):
+        late = sorted(sentAt - time for channel, quantity, time, sentAt in self.timings)
+        planned = max((profile.duration for com, profile in self.programs), default=0)
+        return {
+            "setpoints": len(self.timings),
+            "writes": self.writes,
+            "skipped": self.skipped,
+            "plannedDuration": planned,
+            "achievedDuration": self.timings[-1][3] if self.timings else None,
+            "lateMean": sum(late) / len(late) if late else None,
+            "lateP95": late[min(int(round(0.95 * (len(late) - 1))), len(late) - 1)] if late else None,
+            "lateMax": late[-1] if late else None,
+            "mismatches": list(self.mismatches),
+            "error": None if self.error is None else str(self.error),
+        }
+
+def formatReport(report):
+    ms = lambda value: "-" if value is None else "{:.2f} ms".format(value * 1e3)
+    lines = [
+        "{} setpoints in {} writes, {} skipped".format(report["setpoints"], report["writes"], report["skipped"]),
+        "planned {:.3f} s, achieved {}".format(report["plannedDuration"], "-" if report["achievedDuration"] is None
+                                               else "{:.3f} s".format(report["achievedDuration"])),
+        "late mean {}  p95 {}  max {}".format(ms(report["lateMean"]), ms(report["lateP95"]), ms(report["lateMax"])),
+    ]
+    for channel, quantity, time, value, actual in report["mismatches"]:
+        lines.append("CH {} {} at {:.3f} s: set {} read back {}".format(channel, quantity, time, value, actual))
+    if report["error"] is not None:
+        lines.append("Stopped: {}".format(report["error"]))
+    return "\n".join(lines)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""PSU_Simulator.py: Simulates Delta Elektronika SM power supplies behind a RS232 multidrop interface."""
+
+__author__      = "Owen Dennis McGinnis"
+__email__       = "mcginnis@atom.uni-frankfurt.de"
+
+
+import os
+import random
+import sys
+import threading
+import serial
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qs
+
+FRAME_TERMINATOR = b"\n\r\x04"
+SIMULATOR_SCHEME = "psusim://"
+
+# Named buses, so several ports opened with the same name share one bus
+buses = {}
+busesLock = threading.Lock()
+
+
+class SimulatedPsu:
+    """One SM supply with an ohmic load on its output."""
+    def __init__(self, channel, voltageMax=15.0, currentMax=10.0, load=10.0, noise=0.0005):
+        self.channel = channel
+        self.voltageMax = voltageMax
+        self.currentMax = currentMax
+        self.load = load
+        self.noise = noise
+        self.voltageSet = 0.0
+        self.currentSet = 0.0
+        self.rsd = 1
+        self.outp = 0
+        self.remoteCV = 0
+        self.remoteCC = 0
+        # The potentiometers on the front panel used in local mode
+        self.voltageLocal = 0.0
+        self.currentLocal = 0.0
+
+    def isOn(self):
+        return self.rsd == 0 and self.outp == 1
+
+    def output(self):
+        if not self.isOn():
+            return 0.0, 0.0
+        voltage = self.voltageSet if self.remoteCV else self.voltageLocal
+        current = self.currentSet if self.remoteCC else self.currentLocal
+        # Constant voltage until the load pulls more than the current limit
+        voltage = min(voltage, current * self.load)
+        current = voltage / self.load
+        voltage *= 1 + random.uniform(-self.noise, self.noise)
+        current *= 1 + random.uniform(-self.noise, self.noise)
+        return voltage, current
+
+    def identification(self):
+        return "DELTA ELEKTRONIKA BV, SM {:g}-{:g}, SIM{:04d}, SIMULATOR".format(self.voltageMax, self.currentMax, self.channel)
+
+    def handle(self, node, argument):
+        # Returns the answer for queries, None for settings
+        if node == "SO:VO":
+            if argument is None:
+                return "{:.4f}".format(self.voltageSet)
+            self.voltageSet = min(max(float(argument), 0.0), self.voltageMax)
+        elif node == "SO:CU":
+            if argument is None:
+                return "{:.4f}".format(self.currentSet)
+            self.currentSet = min(max(float(argument), 0.0), self.currentMax)
+        elif node in ("SO:VO:MA", "VO:MA"):
+            return "{:.4f}".format(self.voltageMax)
+        elif node in ("SO:CU:MA", "CU:MA"):
+            return "{:.4f}".format(self.currentMax)
+        elif node == "ME:VO":
+            return "{:.4f}".format(self.output()[0])
+        elif node == "ME:CU":
+            return "{:.4f}".format(self.output()[1])
+        elif node in ("SO:FU:RS", "FU:RS"):
+            if argument is None:
+                return str(self.rsd)
+            self.rsd = 1 if argument.upper() in ("1", "ON") else 0
+        elif node in ("SO:FU:OU", "FU:OU"):
+            if argument is None:
+                return str(self.outp)
+            self.outp = 1 if argument.upper() in ("1", "ON") else 0
+        elif node == "RE:CV":
+            if argument is None:
+                return str(self.remoteCV)
+            self.remoteCV = 1
+        elif node == "RE:CC":
+            if argument is None:
+                return str(self.remoteCC)
+            self.remoteCC = 1
+        elif node == "LO:CV":
+            self.remoteCV = 0
+        elif node == "LO:CC":
+            self.remoteCC = 0
+        elif node == "*I":
+            return self.identification()
+        return None
+
+class SimulatedBus:
+    """The multidrop bus: CH n addresses one supply, everything else goes to it.
+
+    Addresses without a supply stay silent, just like on the real bus.
+    """
+    def __init__(self, channels=(1,), **psuOptions):
+        self.supplies = {channel: SimulatedPsu(channel, **psuOptions) for channel in channels}
+        self.activeChannel = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def node(command):
+        # SCPI accepts short and long forms, the first two letters of every
+        # node tell all commands used here apart.
+        return ":".join(part[:2].upper() for part in command.split(":"))
+
+    def handle(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        command, _, argument = line.partition(" ")
+        query = command.endswith("?")
+        command = command.rstrip("?")
+        argument = None if query else (argument.strip() or "")
+        with self.lock:
+            if command.upper() == "CH":
+                if query:
+                    return None if self.activeChannel not in self.supplies else str(self.activeChannel)
+                try:
+                    self.activeChannel = int(argument)
+                except ValueError:
+                    pass
+                return None
+            psu = self.supplies.get(self.activeChannel)
+            if psu is None:
+                return None
+            try:
+                answer = psu.handle(self.node(command), argument)
+            except ValueError:
+                return None
+        return answer if query else None
+
+class SimulatedSerial:
+    """Stands in for serial.Serial on a simulated bus.
+
+    Both directions are throttled to the baud rate (10 bits per byte), the
+    supply needs latency seconds per command and measureLatency for MEasure
+    queries. dropRate and garbageRate are the probabilities for an answer to
+    go missing or to be preceded by junk bytes. With deviceBaudrate (device
+    in the URL) the supplies ignore everything sent at another rate. Opened
+    from a URL like
+    psusim://lab?channels=1,2,5&latency=0.01&drop=0.01&garbage=0.01
+    where the host part names a bus that is shared between ports.
+    """
+    def __init__(self, bus=None, baudrate=9600, timeout=0.2, latency=0.005, measureLatency=0.05,
+                 dropRate=0.0, garbageRate=0.0, throttle=True, seed=None, port=None, deviceBaudrate=None, **kwargs):
+        self.bus = SimulatedBus() if bus is None else bus
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = kwargs.get("writeTimeout", kwargs.get("write_timeout"))
+        self.latency = latency
+        self.measureLatency = measureLatency
+        self.dropRate = dropRate
+        self.garbageRate = garbageRate
+        self.deviceBaudrate = deviceBaudrate
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.is_open = True
+        self.lock = threading.Condition()
+        self.partial = b""
+        self.outgoing = []
+        self.inputFree = 0
+        self.deviceFree = 0
+        self.lineFree = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+
+    @classmethod
+    def fromUrl(cls, url, baudrate=9600, **kwargs):
+        parsed = urlparse(url)
+        options = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        channels = tuple(int(channel) for channel in options.pop("channels", "1").split(",") if channel)
+        psuOptions = {}
+        for key in ("voltageMax", "currentMax", "load"):
+            if key in options:
+                psuOptions[key] = float(options.pop(key))
+        if parsed.hostname:
+            with busesLock:
+                bus = buses.get(parsed.hostname)
+                if bus is None:
+                    bus = buses[parsed.hostname] = SimulatedBus(channels, **psuOptions)
+        else:
+            bus = SimulatedBus(channels, **psuOptions)
+        names = {"latency": "latency", "measure": "measureLatency", "drop": "dropRate", "garbage": "garbageRate"}
+        if "device" in options:
+            kwargs["deviceBaudrate"] = int(options["device"])
+        for key, name in names.items():
+            if key in options:
+                kwargs[name] = float(options[key])
+        if "throttle" in options:
+            kwargs["throttle"] = options["throttle"] not in ("0", "false", "no")
+        if "seed" in options:
+            kwargs["seed"] = int(options["seed"])
+        if "baudrate" in options:
+            baudrate = int(options["baudrate"])
+        return cls(bus, baudrate=baudrate, port=url, **kwargs)
+
+    def byteTime(self):
+        return 10 / self.baudrate if self.throttle else 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def fileno(self):
+        raise OSError("Simulated ports have no file descriptor")
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException("Port is closed")
+        data = bytes(data)
+        now = monotonic()
+        byteTime = self.byteTime()
+        with self.lock:
+            lines = (self.partial + data).split(b"\n")
+            self.partial = lines.pop()
+            self.bytesWritten += len(data)
+            for line in lines:
+                self.inputFree = max(now, self.inputFree) + (len(line) + 1) * byteTime
+                if self.deviceBaudrate is not None and self.deviceBaudrate != self.baudrate:
+                    continue
+                text = line.decode("utf-8", "replace")
+                delay = self.measureLatency if SimulatedBus.node(text).startswith("ME") else self.latency
+                self.deviceFree = max(self.inputFree, self.deviceFree) + delay
+                answer = self.bus.handle(text)
+                if answer is None or self.random.random() < self.dropRate:
+                    continue
+                frame = answer.encode("utf-8") + FRAME_TERMINATOR
+                if self.random.random() < self.garbageRate:
+                    frame = bytes(self.random.randrange(256) for _ in range(self.random.randint(1, 4))) + frame
+                start = max(self.deviceFree, self.lineFree)
+                self.lineFree = start + len(frame) * byteTime
+                self.outgoing.append((start, frame))
+            self.lock.notify_all()
+        return len(data)
+
+    def available(self, now):
+        # Bytes that made it over the line by now; the caller holds the lock
+        count = 0
+        byteTime = self.byteTime()
+        for start, frame in self.outgoing:
+            if start > now:
+                break
+            if byteTime:
+                arrived = min(len(frame), int((now - start) / byteTime))
+            else:
+                arrived = len(frame)
+            count += arrived
+            if arrived < len(frame):
+                break
+        return count
+
+    def nextArrival(self, now):
+        byteTime = self.byteTime()
+        for start, frame in self.outgoing:
+            done = start + len(frame) * byteTime
+            if done > now:
+                return max(start + byteTime, now)
+        return None
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            return self.available(monotonic())
+
+    def take(self, size):
+        data = bytearray()
+        while self.outgoing and len(data) < size:
+            start, frame = self.outgoing[0]
+            part = frame[:size - len(data)]
+            data += part
+            if len(part) == len(frame):
+                self.outgoing.pop(0)
+            else:
+                byteTime = self.byteTime()
+                self.outgoing[0] = (start + len(part) * byteTime, frame[len(part):])
+        self.bytesRead += len(data)
+        return bytes(data)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.SerialException("Port is closed")
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self.lock:
+            while True:
+                now = monotonic()
+                available = self.available(now)
+                if available >= size or (deadline is not None and now >= deadline):
+                    return self.take(min(size, available))
+                wake = self.nextArrival(now)
+                waits = [time - now for time in (wake, deadline) if time is not None]
+                self.lock.wait(min(waits) if waits else None)
+
+    def read_until(self, expected=FRAME_TERMINATOR, size=None):
+        data = bytearray()
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while not data.endswith(expected) and (size is None or len(data) < size):
+            timeout = self.timeout
+            if deadline is not None:
+                self.timeout = max(deadline - monotonic(), 0)
+            try:
+                byte = self.read(1)
+            finally:
+                self.timeout = timeout
+            if not byte:
+                break
+            data += byte
+        return bytes(data)
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.outgoing.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+class PtyServer(threading.Thread):
+    """Serves a simulated bus on a pseudo terminal (POSIX only).
+
+    Any program, including PSU_Control.py itself, can open slaveName like a
+    real serial port.
+    """
+    def __init__(self, bus=None, latency=0.005, measureLatency=0.05):
+        super().__init__(name="PtyServer", daemon=True)
+        import pty
+        import tty
+        self.bus = SimulatedBus() if bus is None else bus
+        self.latency = latency
+        self.measureLatency = measureLatency
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.slaveName = os.ttyname(self.slave)
+        self.running = True
+
+    def run(self):
+        partial = b""
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            lines = (partial + data).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                text = line.decode("utf-8", "replace")
+                sleep(self.measureLatency if SimulatedBus.node(text).startswith("ME") else self.latency)
+                answer = self.bus.handle(text)
+                if answer is not None:
+                    os.write(self.master, answer.encode("utf-8") + FRAME_TERMINATOR)
+
+    def stop(self):
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+def serial_class_for_url(url):
+    # Hook of serial.serial_for_url, which calls what it returns with None
+    # for the port and the settings
+    def open(port, **kwargs):
+        return SimulatedSerial.fromUrl(url, **kwargs)
+    return url, open
+
+# serial.serial_for_url looks psusim:// up as the module protocol_psusim of the
+# packages in serial.protocol_handler_packages. PSU_Control adds this module,
+# which stands in for both.
+__path__ = []
+sys.modules[__name__ + ".protocol_psusim"] = sys.modules[__name__]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve simulated SM power supplies on a pseudo terminal.")
+    parser.add_argument("--channels", default="1", help="comma separated channel addresses, default 1")
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--measure-latency", type=float, default=0.05)
+    args = parser.parse_args()
+    server = PtyServer(SimulatedBus(int(channel) for channel in args.channels.split(",")),
+                       args.latency, args.measure_latency)
+    server.start()
+    print("Simulated bus on", server.slaveName)
+    try:
+        server.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,36 @@
+"""conftest.py: Fixtures shared by the tests, simulated buses from PSU_Simulator.py."""
+
+import pytest
+
+import PSU_Control
+import PSU_Simulator
+from PSU_Control import PsuBus
+
+
+@pytest.fixture(autouse=True)
+def stateDirectory(tmp_path, monkeypatch):
+    # topology.json, links.json and state.json of the test only
+    monkeypatch.setattr(PSU_Control, "STATE_DIRECTORY", tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def openBus(request):
+    # Every test gets buses of its own, named after it
+    opened = []
+    def openBus(options="", channels="1,2", baudrate=115200, bus=None):
+        name = "{}{}".format(request.node.name.replace("_", ""), len(opened))
+        url = "psusim://{}?channels={}&latency=0.001&measure=0.002&throttle=0{}".format(name, channels, options)
+        bus = (PsuBus() if bus is None else bus).open(url, baudrate)
+        opened.append(bus)
+        return bus, PSU_Simulator.buses[name]
+    yield openBus
+    for bus in opened:
+        bus.close()
+
+@pytest.fixture
+def configure():
+    def configure(simulated, channel, voltage, current):
+        for line in ("CH {}".format(channel), "SOurce:VOltage {}".format(voltage),
+                     "SOurce:CUrrent {}".format(current)):
+            simulated.handle(line)
+    return configure
@@ -0,0 +1,56 @@
+"""test_PSU_Async.py: The asyncio transport of PSU_Async.py against simulated supplies."""
+
+import asyncio
+
+import PSU_Async
+from PSU_Async import AsyncPsuBus, AsyncPsuControlCom
+
+
+def test_connect_and_discover(openBus):
+    async def run():
+        bus, simulated = openBus("&device=38400", channels="2,4", bus=AsyncPsuBus())
+        await bus.connect(bus.port)
+        channels = await PSU_Async.discover(bus)
+        com = AsyncPsuControlCom(4, bus)
+        await com.initialCom()
+        return bus, channels, com
+    bus, channels, com = asyncio.run(run())
+    assert bus.baudrate == 38400
+    assert sorted(channels) == [2, 4] and "SIM0004" in channels[4]["identification"]
+    assert com.voltageMax == 15.0
+
+def test_update_all_buses_at_once(openBus):
+    async def run():
+        coms = []
+        for voltage in (2, 9):
+            bus, simulated = openBus(channels="1,2", bus=AsyncPsuBus())
+            for line in ("CH 2", "SOurce:VOltage {}".format(voltage)):
+                simulated.handle(line)
+            coms += [AsyncPsuControlCom(1, bus), AsyncPsuControlCom(2, bus)]
+        results = await PSU_Async.updateAll(coms, "initialCom")
+        assert not [result for result in results if isinstance(result, Exception)]
+        await coms[0].psuRemote()
+        await coms[0].voltageRequestedSet(5.5).setVoltage()
+        await PSU_Async.updateAll(coms, "fullUpdate")
+        return coms
+    coms = asyncio.run(run())
+    assert [com.voltageSet for com in coms] == [5.5, 2.0, 0.0, 9.0]
+    assert coms[0].bus is coms[1].bus and coms[0].bus is not coms[2].bus
+
+def test_lost_answers_are_sent_again(openBus):
+    async def run():
+        bus, simulated = openBus("&drop=0.02&seed=5", bus=AsyncPsuBus())
+        com = AsyncPsuControlCom(1, bus)
+        await com.initialCom()
+        failed = 0
+        for _ in range(60):
+            com.cache.clear()
+            try:
+                await com.saveUpdate()
+            except PSU_Async.printableError:
+                failed += 1
+                continue
+            assert (com.voltageMax, com.currentMax) == (15.0, 10.0)
+        return bus, failed
+    bus, failed = asyncio.run(run())
+    assert bus.metrics.retries > failed
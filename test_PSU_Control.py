@@ -0,0 +1,353 @@
+"""test_PSU_Control.py: Bus behaviour of PSU_Control.py against the simulated supplies of PSU_Simulator.py."""
+
+import threading
+import time
+
+import pytest
+
+import PSU_Control
+import PSU_Simulator
+from PSU_Control import (TRACE, TRACE_PRINT, PsuBinaryLog, PsuBinaryLogReader, PsuControlCom, PsuFrameParser,
+                         PsuInterlock, PsuLinkNegotiator, PsuPollScheduler, PsuSession, PsuSetpointQueue,
+                         PsuStateFile, PsuTopology)
+
+
+def test_parser_keeps_partial_frames():
+    parser = PsuFrameParser()
+    parser.feed(b"1.5000\n\r")
+    assert parser.nextFrame() is None
+    parser.feed(b"\x042.0000\n\r\x04" + b"3.0")
+    assert parser.nextFrame() == b"1.5000"
+    assert parser.nextFrame() == b"2.0000"
+    assert parser.nextFrame() is None
+    assert parser.pending() == 3
+
+def test_psusim_is_opened_through_pyserial(openBus):
+    bus, simulated = openBus()
+    assert isinstance(bus.serialConnection, PSU_Simulator.SimulatedSerial)
+    bus.serialConnection.close()
+    with pytest.raises(PSU_Control.serial.SerialException):
+        bus.serialConnection.read(1)
+
+def test_answers_are_framed_through_garbage(openBus, configure):
+    bus, simulated = openBus("&garbage=0.05&seed=1")
+    configure(simulated, 2, 7, 5)
+    com = PsuControlCom(2, bus)
+    failed = 0
+    for _ in range(50):
+        com.cache.clear()
+        try:
+            com.saveUpdate()
+        except ValueError:
+            # Junk in front of an answer twice in a row, nothing was applied
+            failed += 1
+            continue
+        assert (com.voltageSet, com.currentSet, com.voltageMax, com.currentMax) == (7.0, 5.0, 15.0, 10.0)
+    assert failed < 10
+
+def test_batch_resends_a_chunk_with_a_lost_answer(openBus, configure):
+    bus, simulated = openBus("&drop=0.02&seed=3")
+    configure(simulated, 1, 3, 2)
+    com = PsuControlCom(1, bus)
+    failed = 0
+    for _ in range(100):
+        com.cache.clear()
+        try:
+            com.saveUpdate()
+        except PSU_Control.printableError:
+            # Lost twice in a row, nothing was applied
+            failed += 1
+            continue
+        assert (com.voltageSet, com.currentSet, com.voltageMax, com.currentMax) == (3.0, 2.0, 15.0, 10.0)
+    assert bus.metrics.retries > failed
+
+def test_setpoints_are_coalesced(openBus):
+    bus, simulated = openBus()
+    com = PsuControlCom(1, bus)
+    com.initialCom()
+    setpoints = PsuSetpointQueue()
+    assert setpoints.put(com, "voltage", 1.0)
+    for value in (2.0, 3.0, 4.5):
+        assert not setpoints.put(com, "voltage", value)
+    setpoints.put(com, "current", 1.5)
+    written = bus.metrics.bytesSent
+    setpoints.flush()
+    assert (setpoints.dropped, setpoints.sent) == (3, 2)
+    assert (simulated.supplies[1].voltageSet, simulated.supplies[1].currentSet) == (4.5, 1.5)
+    assert (com.voltageSet, com.currentSet) == (4.5, 1.5)
+    assert bus.metrics.bytesSent - written < 100
+
+def test_interlock_switches_the_output_off(openBus, configure):
+    bus, simulated = openBus()
+    configure(simulated, 1, 5, 2)
+    com = PsuControlCom(1, bus)
+    com.initialCom()
+    com.psuRemote().psuOn()
+    assert simulated.supplies[1].isOn()
+    tripped = []
+    com.setInterlock(PsuInterlock(maxCurrent=0.2, onTrip=lambda com, trip: tripped.append(trip)))
+    # 5 V on the 10 Ohm load of the simulator draw 0.5 A
+    com.fullUpdate()
+    deadline = time.monotonic() + 2
+    while not tripped and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [trip["reason"] for trip in tripped] == ["current"]
+    assert tripped[0]["latency"] >= 0
+    assert not simulated.supplies[1].isOn()
+    assert (simulated.supplies[1].rsd, simulated.supplies[1].outp) == (1, 0)
+
+def test_worker_answers_every_job():
+    session = PsuSession((1,))
+    session.add("psusim://?channels=1")
+    def broken():
+        raise OSError("disk full")
+    try:
+        (result, error), (answer, none) = session.gather([("psusim://?channels=1", broken),
+                                                          ("psusim://?channels=1", lambda: 42)])
+        assert isinstance(error, OSError) and result is None
+        assert (answer, none) == (42, None)
+    finally:
+        session.stop()
+
+def test_gather_notices_a_dead_worker():
+    session = PsuSession((1,))
+    worker = session.add("psusim://?channels=1")
+    worker.stop()
+    worker.join(5)
+    (result, error), = session.gather([("psusim://?channels=1", lambda: 42)])
+    assert isinstance(error, PSU_Control.printableError)
+
+def test_state_file_keeps_concurrent_updates(stateDirectory):
+    file = PsuStateFile("topology.json")
+    def update(thread):
+        for i in range(100):
+            file.update("{}-{}".format(thread, i), i)
+    threads = [threading.Thread(target=update, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(file.load()) == 400
+    assert [path.name for path in stateDirectory.iterdir()] == ["topology.json"]
+
+def test_topology_is_scanned_once(openBus):
+    bus, simulated = openBus(channels="2,5")
+    topology = PsuTopology()
+    channels = topology.discover(bus)
+    assert sorted(channels) == [2, 5]
+    assert channels[5]["voltageMax"] == 15.0 and "SIM0005" in channels[5]["identification"]
+    written = bus.metrics.bytesSent
+    assert sorted(PsuTopology().discover(bus)) == [2, 5]
+    # Only the two known channels were probed
+    assert bus.metrics.bytesSent - written < 40
+    del simulated.supplies[5]
+    assert sorted(PsuTopology().discover(bus)) == [2]
+
+def test_topology_works_without_state_directory(openBus, tmp_path):
+    bus, simulated = openBus()
+    (tmp_path / "file").write_text("")
+    topology = PsuTopology(PsuStateFile("topology.json", tmp_path / "file" / "state"))
+    assert sorted(topology.discover(bus)) == [1, 2]
+
+def test_trace_stays_off_stdout(openBus, capsys, monkeypatch):
+    bus, simulated = openBus()
+    monkeypatch.setattr(TRACE, "level", TRACE_PRINT)
+    PsuControlCom(1, bus).initialCom()
+    TRACE.dump()
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert "Received:" in err and "write" in err
+
+def test_outputs_that_are_off_are_not_measured(openBus, configure):
+    bus, simulated = openBus("&measure=0.3")
+    configure(simulated, 1, 5, 2)
+    off, on = PsuControlCom(1, bus).initialCom(), PsuControlCom(2, bus).initialCom()
+    on.psuRemote().psuOn()
+    scheduler = PsuPollScheduler([off], burst=1)
+    started = time.monotonic()
+    scheduler.step()
+    assert time.monotonic() - started < 0.2
+    assert off.samples.latest()[1:] == (-1, -1, 1)
+    scheduler = PsuPollScheduler([on], burst=1)
+    scheduler.step()
+    assert on.samples.latest()[3] == 0 and on.samples.latest()[1] >= 0
+
+def test_scheduler_polls_by_weight(openBus, configure):
+    bus, simulated = openBus(channels="1,2,3")
+    configure(simulated, 2, 1, 1)
+    coms = [PsuControlCom(channel, bus).initialCom() for channel in (1, 2, 3)]
+    coms[1].psuRemote().psuOn()
+    scheduler = PsuPollScheduler(coms, maxRate=1000)
+    scheduler.focus(coms[0])
+    polls = {com.channel: 0 for com in coms}
+    for _ in range(130):
+        polls[scheduler.step().channel] += 1
+    # Weights 8 for the focused, 4 for the active and 1 for the idle channel
+    assert polls[1] > polls[2] > polls[3] > 0
+
+def test_link_runs_at_the_rate_of_the_supplies(openBus):
+    bus, simulated = openBus("&device=19200", channels="3")
+    bus.connect(bus.port)
+    assert bus.baudrate == 19200
+    assert PsuLinkNegotiator().cached(bus.port) == 19200
+    # The scan of the negotiation is taken by discover
+    written = bus.metrics.bytesSent
+    assert sorted(PsuTopology().discover(bus)) == [3]
+    assert bus.metrics.bytesSent - written < 60
+    # Next time the saved rate is only checked
+    started = time.monotonic()
+    bus.close()
+    bus.connect(bus.port)
+    assert bus.baudrate == 19200 and time.monotonic() - started < 0.5
+
+def test_link_fails_without_supplies(openBus):
+    bus, simulated = openBus("&device=300")
+    with pytest.raises(PSU_Control.printableError):
+        PsuLinkNegotiator(rates=(115200, 9600), tries=1).negotiate(bus, bus.port)
+    assert not bus.is_connected()
+
+def test_adapter_is_found_again_under_another_name(openBus, configure):
+    bus, simulated = openBus(channels="2")
+    back, simulatedBack = openBus(channels="2")
+    configure(simulatedBack, 2, 3, 1)
+    port, device = bus.port, back.port
+    bus.close()
+    back.close()
+    session = PsuSession((2,))
+    session.add(port)
+    try:
+        for result, error in session.gather([(port, session.connect, port, None, "USB VID:PID=0403:6001 SER=A1"),
+                                             (port, session.discover, port), (port, session.initChannel, port, 2)]):
+            assert error is None
+        assert session.adapterPort("USB VID:PID=0403:6001 SER=A1") is None
+        # Unplugged, and back as another device
+        (result, error), = session.gather([(port, session.workers[port].bus.close)])
+        assert session.adapterPort("USB VID:PID=0403:6001 SER=B2") is None
+        assert session.adapterPort("USB VID:PID=0403:6001 SER=A1") == port
+        (found, error), = session.gather([(port, session.reconnect, port, None, True, device)])
+        assert error is None and found == [2]
+        assert session.workers[port].bus.port == device
+        assert session.com(port, 2).voltageSet == 3.0
+    finally:
+        session.stop()
+
+def test_binary_log_range_queries(tmp_path):
+    path = tmp_path / "channel03.psulog"
+    log = PsuBinaryLog(path, 3, chunk=16)
+    for i in range(100):
+        log.write(1000.0 + i, i / 10, i / 100, 0)
+    log.close()
+    with PsuBinaryLogReader(path) as reader:
+        assert len(reader) == 100 and reader.channel == 3
+        times = [record[0] for record in reader.records()]
+        assert times == sorted(times)
+        start, stop = reader.range(times[10], times[20])
+        assert (start, stop) == (10, 20)
+        assert [record[1] for record in reader.records(times[10], times[12])] == [1.0, 1.1]
+        assert reader.range(times[-1] + 1) == (100, 100)
+    # A record cut short by a crash is dropped when the log is opened again
+    with open(path, "ab") as file:
+        file.write(b"\0" * 9)
+    PsuBinaryLog(path, 3).close()
+    with PsuBinaryLogReader(path) as reader:
+        assert len(reader) == 100
+    with pytest.raises(PSU_Control.printableError):
+        PsuBinaryLog(path, 4)
+
+def test_polls_are_logged(openBus, configure, tmp_path):
+    bus, simulated = openBus()
+    configure(simulated, 1, 5, 2)
+    com = PsuControlCom(1, bus).initialCom()
+    com.psuRemote().psuOn()
+    com.logTo(tmp_path, chunk=4)
+    for _ in range(10):
+        com.fullUpdate()
+    com.stopLog()
+    with PsuBinaryLogReader(PsuBinaryLog.pathFor(tmp_path, 1)) as reader:
+        assert len(reader) == 10
+        assert all(abs(voltage - 5) < 0.1 and status == 0 for t, voltage, current, status in reader.records())
+
+def test_cache_skips_parameters_until_they_change(openBus, configure):
+    bus, simulated = openBus()
+    configure(simulated, 1, 3, 2)
+    com = PsuControlCom(1, bus).initialCom()
+    written = bus.metrics.bytesSent
+    com.saveUpdate()
+    # Only CH and the status went out, the rest came from the cache
+    assert bus.metrics.bytesSent - written < 60
+    assert (com.voltageSet, com.currentSet) == (3.0, 2.0)
+    com.voltageRequestedSet(4.0).setVoltage()
+    com.saveUpdate()
+    assert com.voltageSet == 4.0
+    com.psuRemote()
+    com.saveUpdate()
+    assert com.isRemote == 1
+    # A change behind the back of the cache shows once the bus was opened again
+    configure(simulated, 1, 6, 2)
+    com.saveUpdate()
+    assert com.voltageSet == 4.0
+    bus.open(bus.port, bus.baudrate)
+    com.saveUpdate()
+    assert com.voltageSet == 6.0
+
+def test_cache_entries_expire():
+    cache = PSU_Control.PsuParamCache({"voltageSet": 0.05, "max": None})
+    cache.put("voltageSet", (1.0,)).put("max", (15.0, 10.0))
+    assert cache.get("voltageSet") == (True, (1.0,))
+    time.sleep(0.06)
+    assert cache.get("voltageSet") == (False, None)
+    assert cache.get("max") == (True, (15.0, 10.0))
+    cache.generation(1).generation(2)
+    assert cache.get("max") == (False, None)
+
+def test_warm_start_from_the_last_session(openBus, configure):
+    bus, simulated = openBus()
+    configure(simulated, 2, 3, 1)
+    port = bus.port
+    bus.close()
+    def start():
+        session = PsuSession((1, 2))
+        session.add(port)
+        for result, error in session.gather([(port, session.connect, port, 115200), (port, session.discover, port),
+                                             (port, session.initChannel, port, 2, False)]):
+            assert error is None
+        return session
+    session = start()
+    assert session.warmStarts == 0
+    session.stop(last=(port, 2))
+    session = start()
+    assert session.warmStarts == 1
+    assert session.warm.last() == (port, 2)
+    com = session.com(port, 2)
+    assert (com.voltageSet, com.currentSet, com.voltageMax) == (3.0, 1.0, 15.0)
+    session.stop()
+    # Changed while nobody watched: a full initialCom after all
+    configure(simulated, 2, 4, 1)
+    session = start()
+    assert session.warmStarts == 0
+    assert session.com(port, 2).voltageSet == 4.0
+    session.stop()
+
+def test_warm_start_checks_the_maximum_values(openBus):
+    bus, simulated = openBus()
+    state = PsuControlCom(1, bus).initialCom().warmState()
+    assert PsuControlCom(1, bus).warmCom(state)
+    com = PsuControlCom(1, bus)
+    assert not com.warmCom(dict(state, voltageMax=30.0))
+    assert com.voltageMax == 15.0
+
+def test_sample_buffer_is_allocated_on_the_first_sample():
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        coms = [PsuControlCom(channel) for channel in range(1, 30)]
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 1 << 20
+    samples = coms[0].samples
+    assert samples.latest() is None and [len(view) for view in samples.column("voltage")] == [0]
+    assert samples.since(0, "voltage")[0] == 0
+    samples.append(1.0, 2.0, 0.5, 0)
+    assert samples.latest() == (1.0, 2.0, 0.5, 0)
+    assert list(samples.column("current")[0]) == [0.5]
@@ -0,0 +1,34 @@
+"""test_PSU_Sequence.py: PsuSequencer of PSU_Sequence.py against simulated supplies."""
+
+from PSU_Control import PsuControlCom
+from PSU_Sequence import PsuProfile, PsuSequencer
+
+
+def test_verify_reads_back_every_channel(openBus):
+    # More read-backs than fit in one pipelined chunk, on five channels
+    bus, simulated = openBus(channels="1,2,3,4,5")
+    coms = [PsuControlCom(channel, bus).initialCom() for channel in range(1, 6)]
+    programs = [(com, PsuProfile([(0, com.channel, com.channel / 10), (0.05, com.channel + 0.5, None)]))
+                for com in coms]
+    sequencer = PsuSequencer(programs, verify=True)
+    sequencer.start()
+    sequencer.join(10)
+    report = sequencer.report()
+    assert report["error"] is None
+    assert report["mismatches"] == []
+    assert report["setpoints"] == 15
+    for com in coms:
+        supply = simulated.supplies[com.channel]
+        assert (supply.voltageSet, supply.currentSet) == (com.channel + 0.5, com.channel / 10)
+        assert (com.voltageSet, com.currentSet) == (com.channel + 0.5, com.channel / 10)
+
+def test_late_counts_from_the_write(openBus):
+    bus, simulated = openBus()
+    com = PsuControlCom(1, bus).initialCom()
+    sequencer = PsuSequencer([(com, PsuProfile.ramp(0, 2, 0.2, 0.05))])
+    sequencer.run()
+    report = sequencer.report()
+    assert report["setpoints"] == 5
+    assert 0 <= report["lateMean"] <= report["lateMax"] < 0.05
+    assert [sentAt for channel, quantity, time, sentAt in sequencer.timings] == sorted(
+        sentAt for channel, quantity, time, sentAt in sequencer.timings)